@@ -7,16 +7,27 @@ import sys
 import re
 import aiosqlite
 import aiohttp
+from aiohttp import web
+import gallery_dl
 import time
+import random
 import json
 import traceback
 import io
+import socket
+import contextlib
+from collections import OrderedDict, deque, namedtuple
 from pyrogram import Client, filters, idle, enums
+from pyrogram.errors import FloodWait
 from pyrogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton, 
-    InputMediaPhoto, BotCommand, ReplyParameters
+    InputMediaPhoto, BotCommand, ReplyParameters,
+    InlineQueryResultCachedVideo, InlineQueryResultCachedPhoto, InlineQueryResultCachedAudio
 )
-import yt_dlp
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import ytdlp_worker
 
 try:
     import config
@@ -28,10 +39,48 @@ except ImportError:
 API_ID = config.API_ID
 API_HASH = config.API_HASH
 BOT_TOKEN = config.BOT_TOKEN
-DB_NAME = "cache.db"
+DB_NAME = getattr(config, 'DB_PATH', "cache.db")
 DOWNLOAD_PATH = "downloads"
 SETTINGS_FILE = "user_settings.json"
 
+# "standalone" (default), "front" (takes updates, queues downloads) or "worker"
+# (runs queued downloads); `python KPDLoader.py worker 2` starts worker #2
+ROLE = getattr(config, 'ROLE', "standalone")
+WORKER_ID = getattr(config, 'WORKER_ID', 1)
+if __name__ == "__main__" and len(sys.argv) > 1:
+    ROLE = sys.argv[1]
+    if len(sys.argv) > 2: WORKER_ID = sys.argv[2]
+if ROLE not in ("standalone", "front", "worker"):
+    print(f"❌ ERROR: unknown role {ROLE!r}")
+    print("💡 HINT: ROLE must be \"standalone\", \"front\" or \"worker\"")
+    sys.exit(1)
+WORKER_NAME = f"{socket.gethostname()}:{os.getpid()}"
+JOB_LEASE = 60
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 15
+JOB_POLL_INTERVAL = 1
+
+PLATFORM_WORKERS = {"tiktok": 3, "shorts": 2, "instagram": 2, "music": 2}
+PLATFORM_WORKERS.update(getattr(config, 'WORKERS', {}))
+QUEUE_LIMIT = getattr(config, 'QUEUE_LIMIT', 100)
+YTDLP_BACKEND = getattr(config, 'YTDLP_BACKEND', 'thread')
+YTDLP_PROCESSES = getattr(config, 'YTDLP_PROCESSES', os.cpu_count() or 2)
+HTTP_CONNECTIONS = getattr(config, 'HTTP_CONNECTIONS', 64)
+YTDLP_RETRIES = getattr(config, 'YTDLP_RETRIES', 2)
+SEND_RATE = getattr(config, 'SEND_RATE', 25)
+CHAT_SEND_RATE = getattr(config, 'CHAT_SEND_RATE', 1)
+SEND_RETRIES = 3
+CACHE_CHAT_ID = getattr(config, 'CACHE_CHAT_ID', getattr(config, 'OWNER_ID', None))
+INLINE_FETCH_LIMIT = getattr(config, 'INLINE_FETCH_LIMIT', 5)
+SEND_MAX_WAIT = 300
+GALLERY_WORKERS = getattr(config, 'GALLERY_WORKERS', PLATFORM_WORKERS['tiktok'])
+MAX_UPLOAD_BYTES = getattr(config, 'MAX_UPLOAD_MB', 2000) * 1024 * 1024
+REENCODE_OVERSIZE = getattr(config, 'REENCODE_OVERSIZE', False)
+METRICS_HOST = getattr(config, 'METRICS_HOST', "127.0.0.1")
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)
+SETTINGS_CACHE_SIZE = getattr(config, 'SETTINGS_CACHE_SIZE', 10000)
+SETTINGS_FLUSH_DELAY = 2
+
 DEFAULT_SETTINGS = {
     "audio": True,
     "desc": True,
@@ -39,36 +88,266 @@ DEFAULT_SETTINGS = {
     "link_btn": True 
 }
 
-def load_settings():
-    if os.path.exists(SETTINGS_FILE):
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - [%(levelname)s] - %(name)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+if ROLE == "worker":
+    # workers only send; each needs its own session file
+    app = Client(f"my_bot_worker{WORKER_ID}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, sleep_threshold=0, no_updates=True)
+else:
+    app = Client("my_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, sleep_threshold=0)
+
+CACHE_TTL = 259200
+CACHE_SWEEP_INTERVAL = 3600
+CACHE_HIT_FLUSH_INTERVAL = 30
+CACHE_HOT_HITS = getattr(config, 'CACHE_HOT_HITS', 10)
+CACHE_MAX_ROWS = getattr(config, 'CACHE_MAX_ROWS', 200000)
+CACHE_MAX_MB = getattr(config, 'CACHE_MAX_MB', None)
+
+class Metrics:
+    """Per-stage latency histograms and counters, exported in Prometheus text format."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.stages = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds):
+        stat = self.stages.get(stage)
+        if stat is None:
+            stat = self.stages[stage] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0, 'max': 0.0}
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                stat['buckets'][i] += 1
+        stat['sum'] += seconds
+        stat['count'] += 1
+        stat['max'] = max(stat['max'], seconds)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.monotonic()
         try:
-            with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return {int(k): v for k, v in data.items()}
+            yield
+        except BaseException:
+            self.inc("stage_errors_total", stage=stage)
+            raise
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def quantile(self, stage, q):
+        """Upper bucket bound below which a q share of the stage's spans finished."""
+        stat = self.stages[stage]
+        for bound, count in zip(self.BUCKETS, stat['buckets']):
+            if count >= q * stat['count']:
+                return min(bound, stat['max'])
+        return stat['max']
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"kpd_{name}{{{label_text}}} {value}" if label_text else f"kpd_{name} {value}")
+        for stage, stat in sorted(self.stages.items()):
+            for bound, count in zip(self.BUCKETS, stat['buckets']):
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'kpd_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'kpd_stage_seconds_sum{{stage="{stage}"}} {stat["sum"]:.6f}')
+            lines.append(f'kpd_stage_seconds_count{{stage="{stage}"}} {stat["count"]}')
+        lines.append(f"kpd_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+async def start_metrics_server():
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+def format_size(num):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024:
+            return f"{num:.1f} {unit}"
+        num /= 1024
+    return f"{num:.1f} TB"
+
+class TTLCache:
+    """Small in-memory LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+meta_cache = TTLCache(128, 300)
+url_cache = TTLCache(4096, 86400)
+
+class TokenBucket:
+    """Token bucket handing out reservations: reserve() returns how long to wait before sending."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def reserve(self, cost):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class SendGovernor:
+    """Paces outgoing Telegram calls to stay under the bot API flood limits."""
+
+    def __init__(self, rate, chat_rate, chat_burst):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats = TTLCache(10000, 600)
+        self.status_edits = {}
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id) or TokenBucket(self.chat_rate, self.chat_burst)
+        self.chats.set(chat_id, bucket)
+        return bucket
+
+    async def send(self, stage, chat_id, call, upload=(), cost=1):
+        """Await call() once both buckets allow it, counting the bytes of any local files it uploads."""
+        for attempt in range(SEND_RETRIES + 1):
+            delay = max(self.bucket.reserve(cost), self.chat_bucket(chat_id).reserve(2 if cost > 1 else cost))
+            if delay > 0:
+                metrics.observe("send_wait", delay)
+                await asyncio.sleep(delay)
+            try:
+                with metrics.span(stage):
+                    result = await call()
+            except FloodWait as e:
+                metrics.inc("flood_waits_total")
+                if attempt == SEND_RETRIES or e.value > SEND_MAX_WAIT:
+                    raise
+                logging.warning(f"FloodWait of {e.value}s in chat {chat_id}, rescheduling {stage}")
+                self.chat_bucket(chat_id).pause(e.value)
+                continue
+            for path in upload:
+                if isinstance(path, str) and os.path.isfile(path):
+                    metrics.inc("bytes_uploaded_total", os.path.getsize(path))
+            return result
+
+    async def edit_status(self, status, text, **kwargs):
+        """Best-effort status edit; if an earlier edit is still waiting for its turn, it sends this text instead."""
+        key = (status.chat.id, status.id)
+        pending = self.status_edits.get(key)
+        if pending is not None:
+            pending.update(text=text, kwargs=kwargs)
+            metrics.inc("status_edits_coalesced_total")
+            return
+        pending = self.status_edits[key] = {'text': text, 'kwargs': kwargs, 'deleted': False}
+
+        async def call():
+            self.status_edits.pop(key, None)
+            if not pending['deleted']:
+                await status.edit_text(pending['text'], **pending['kwargs'])
+
+        try:
+            await self.send("edit_status", status.chat.id, call)
         except Exception as e:
-            logging.error(f"Error loading settings: {e}")
-    return {}
+            self.status_edits.pop(key, None)
+            logging.warning(f"Status edit failed: {e}")
 
-def save_settings_to_file():
-    try:
-        with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_settings, f, indent=4)
-    except Exception as e:
-        logging.error(f"Error saving settings: {e}")
+    async def delete_status(self, status):
+        pending = self.status_edits.pop((status.chat.id, status.id), None)
+        if pending: pending['deleted'] = True
+        try:
+            await self.send("delete_status", status.chat.id, status.delete, cost=0)
+        except Exception as e:
+            logging.warning(f"Status delete failed: {e}")
 
-user_settings = load_settings()
+governor = SendGovernor(SEND_RATE, CHAT_SEND_RATE, 3)
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - [%(levelname)s] - %(name)s - %(message)s")
-logger = logging.getLogger(__name__)
+class CacheStore:
+    """Long-lived connection to the file_id cache."""
 
-app = Client("my_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+    SELECT_SQL = "SELECT video_id, audio_id, caption, photos, audio_title, audio_performer FROM cache WHERE url = ? AND (last_access >= ? OR hits >= ?)"
+    UPSERT_SQL = """
+        INSERT INTO cache (url, video_id, audio_id, caption, photos, audio_title, audio_performer, timestamp, last_access, hits)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+        ON CONFLICT(url) DO UPDATE SET
+            video_id = COALESCE(excluded.video_id, video_id),
+            audio_id = COALESCE(excluded.audio_id, audio_id),
+            caption = COALESCE(excluded.caption, caption),
+            photos = COALESCE(excluded.photos, photos),
+            audio_title = COALESCE(excluded.audio_title, audio_title),
+            audio_performer = COALESCE(excluded.audio_performer, audio_performer),
+            timestamp = excluded.timestamp,
+            last_access = excluded.last_access
+    """
+    HITS_SQL = "UPDATE cache SET hits = hits + ?, last_access = MAX(last_access, ?) WHERE url = ?"
+    SWEEP_SQL = "DELETE FROM cache WHERE last_access < ? AND hits < ?"
+    EVICT_SQL = """
+        DELETE FROM cache WHERE url IN (
+            SELECT url FROM cache ORDER BY hits >= ?, last_access LIMIT ?
+        )
+    """
 
-if not os.path.exists(DOWNLOAD_PATH):
-    os.makedirs(DOWNLOAD_PATH)
+    def __init__(self, path):
+        self.path = path
+        self.con = None
+        self.pending_hits = {}
 
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as con:
-        await con.execute("""
+    async def open(self):
+        self.con = await aiosqlite.connect(self.path)
+        await self.con.execute("PRAGMA busy_timeout=10000")
+        async with self.con.execute("PRAGMA auto_vacuum") as cur:
+            auto_vacuum = (await cur.fetchone())[0]
+        if auto_vacuum != 2:
+            # switching an existing database to incremental mode needs one full VACUUM
+            await self.con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await self.con.execute("VACUUM")
+        await self.con.execute("PRAGMA journal_mode=WAL")
+        await self.con.execute("PRAGMA synchronous=NORMAL")
+        await self.con.execute("""
             CREATE TABLE IF NOT EXISTS cache (
                 url TEXT PRIMARY KEY,
                 video_id TEXT,
@@ -78,200 +357,774 @@ async def init_db():
                 timestamp REAL
             )
         """)
-        try:
-            await con.execute("ALTER TABLE cache ADD COLUMN photos TEXT")
-        except Exception:
-            pass
-            
-        await con.commit()
+        for column in ("photos TEXT", "audio_title TEXT", "audio_performer TEXT", "last_access REAL", "hits INTEGER NOT NULL DEFAULT 0"):
+            try:
+                await self.con.execute(f"ALTER TABLE cache ADD COLUMN {column}")
+            except Exception:
+                pass
+        await self.con.execute("UPDATE cache SET last_access = timestamp WHERE last_access IS NULL")
+        await self.con.execute("DROP INDEX IF EXISTS cache_timestamp")
+        await self.con.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        await self.con.commit()
 
-async def get_cache(url):
-    async with aiosqlite.connect(DB_NAME) as con:
-        await con.execute("DELETE FROM cache WHERE timestamp < ?", (time.time() - 259200,))
-        await con.commit()
-        
-        async with con.execute("SELECT video_id, audio_id, caption, photos FROM cache WHERE url = ?", (url,)) as cur:
+    async def close(self):
+        if self.con:
+            await self.flush_hits()
+            await self.con.close()
+            self.con = None
+
+    async def get(self, url):
+        now = time.time()
+        async with self.con.execute(self.SELECT_SQL, (url, now - CACHE_TTL, CACHE_HOT_HITS)) as cur:
             row = await cur.fetchone()
+        if row:
+            hits, _ = self.pending_hits.get(url, (0, now))
+            self.pending_hits[url] = (hits + 1, now)
+            return {
+                'video': row[0],
+                'audio': row[1],
+                'caption': row[2],
+                'photos': json.loads(row[3]) if row[3] else None,
+                'audio_title': row[4],
+                'audio_performer': row[5]
+            }
+        return None
+
+    async def update(self, url, video_id=None, audio_id=None, caption=None, photos=None, audio_title=None, audio_performer=None):
+        now = time.time()
+        await self.con.execute(self.UPSERT_SQL, (
+            url,
+            video_id or None,
+            audio_id or None,
+            caption or None,
+            json.dumps(photos) if photos else None,
+            audio_title or None,
+            audio_performer or None,
+            now,
+            now
+        ))
+        await self.con.commit()
+
+    async def migrate_keys(self, key_func):
+        """Rewrite rows still keyed by a raw URL to their canonical key."""
+        async with self.con.execute("SELECT url FROM cache WHERE url LIKE 'http%'") as cur:
+            urls = [row[0] for row in await cur.fetchall()]
+        migrated = 0
+        for url in urls:
+            key = key_func(url)
+            if not key:
+                continue
+            cur = await self.con.execute("UPDATE OR IGNORE cache SET url = ? WHERE url = ?", (key, url))
+            if cur.rowcount:
+                migrated += 1
+            else:
+                await self.con.execute("DELETE FROM cache WHERE url = ?", (url,))
+        await self.con.commit()
+        if migrated:
+            logging.info(f"Migrated {migrated} cache rows to canonical keys")
+
+    async def flush_hits(self):
+        if not self.pending_hits:
+            return
+        batch, self.pending_hits = self.pending_hits, {}
+        await self.con.executemany(self.HITS_SQL, [(hits, last_access, url) for url, (hits, last_access) in batch.items()])
+        await self.con.commit()
+
+    async def sweep(self):
+        cur = await self.con.execute(self.SWEEP_SQL, (time.time() - CACHE_TTL, CACHE_HOT_HITS))
+        await self.con.commit()
+        return cur.rowcount
+
+    async def row_limit(self):
+        """CACHE_MAX_ROWS, lowered to what fits into CACHE_MAX_MB at the current average row size."""
+        async with self.con.execute("SELECT COUNT(*) FROM cache") as cur:
+            rows = (await cur.fetchone())[0]
+        limit = CACHE_MAX_ROWS
+        if CACHE_MAX_MB and rows:
+            pragmas = []
+            for pragma in ("page_count", "freelist_count", "page_size"):
+                async with self.con.execute(f"PRAGMA {pragma}") as cur:
+                    pragmas.append((await cur.fetchone())[0])
+            page_count, freelist_count, page_size = pragmas
+            row_bytes = (page_count - freelist_count) * page_size / rows
+            limit = min(limit, int(CACHE_MAX_MB * 1024 * 1024 / row_bytes))
+        return rows, limit
+
+    async def evict(self):
+        rows, limit = await self.row_limit()
+        if rows <= limit:
+            return 0
+        # leave some headroom so the next sweep doesn't have to evict again right away
+        cur = await self.con.execute(self.EVICT_SQL, (CACHE_HOT_HITS, rows - int(limit * 0.9)))
+        await self.con.commit()
+        return cur.rowcount
+
+    async def compact(self):
+        # incremental_vacuum frees one page per step and execute() only steps it once,
+        # leaving it active so the checkpoint finds the table locked; executescript
+        # runs it to completion
+        await self.con.executescript("PRAGMA incremental_vacuum;")
+        async with self.con.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+            await cur.fetchall()
+
+    async def sweep_loop(self):
+        last_sweep = None
+        while True:
+            try:
+                await self.flush_hits()
+                if last_sweep is None or time.monotonic() - last_sweep >= CACHE_SWEEP_INTERVAL:
+                    last_sweep = time.monotonic()
+                    removed = await self.sweep()
+                    evicted = await self.evict()
+                    metrics.inc("cache_evicted_total", removed + evicted)
+                    if removed or evicted:
+                        logging.info(f"Cache sweep removed {removed} expired and evicted {evicted} cold rows")
+                        await self.compact()
+            except Exception as e:
+                logging.error(f"Cache sweep error: {e}")
+            await asyncio.sleep(CACHE_HIT_FLUSH_INTERVAL)
+
+cache_store = CacheStore(DB_NAME)
+
+async def get_cache(url):
+    with metrics.span("get_cache"):
+        return await cache_store.get(url)
+
+async def update_cache(url, video_id=None, audio_id=None, caption=None, photos=None, audio_title=None, audio_performer=None):
+    with metrics.span("update_cache"):
+        await cache_store.update(url, video_id=video_id, audio_id=audio_id, caption=caption, photos=photos,
+                                 audio_title=audio_title, audio_performer=audio_performer)
+
+class SettingsStore:
+    """Per-chat settings, one row per chat in the cache database."""
+
+    UPSERT_SQL = "INSERT INTO settings (chat_id, data) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data"
+
+    def __init__(self, store, maxsize):
+        self.store = store
+        self.cache = TTLCache(maxsize, 3600)
+        self.dirty = {}
+        self.flusher = None
+
+    async def open(self):
+        await self.store.con.execute("CREATE TABLE IF NOT EXISTS settings (chat_id INTEGER PRIMARY KEY, data TEXT)")
+        await self.store.con.commit()
+
+    async def migrate_json(self, path):
+        """One-time import of the old user_settings.json; the file is renamed afterwards."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            await self.store.con.executemany(
+                "INSERT OR IGNORE INTO settings (chat_id, data) VALUES (?, ?)",
+                [(int(chat_id), json.dumps(value)) for chat_id, value in data.items()]
+            )
+            await self.store.con.commit()
+            os.replace(path, path + ".migrated")
+            logging.info(f"Migrated settings of {len(data)} chats from {path}")
+        except Exception as e:
+            logging.error(f"Error migrating settings: {e}")
+
+    async def get(self, chat_id):
+        settings = self.dirty.get(chat_id) or self.cache.get(chat_id)
+        if settings is None:
+            async with self.store.con.execute("SELECT data FROM settings WHERE chat_id = ?", (chat_id,)) as cur:
+                row = await cur.fetchone()
+            settings = DEFAULT_SETTINGS.copy()
             if row:
-                return {
-                    'video': row[0],
-                    'audio': row[1],
-                    'caption': row[2],
-                    'photos': json.loads(row[3]) if row[3] else None
-                }
-            return None
+                settings.update(json.loads(row[0]))
+            self.cache.set(chat_id, settings)
+        return settings
 
-async def update_cache(url, video_id=None, audio_id=None, caption=None, photos=None):
-    async with aiosqlite.connect(DB_NAME) as con:
-        await con.execute("INSERT OR IGNORE INTO cache (url, timestamp) VALUES (?, ?)", (url, time.time()))
-        if video_id:
-            await con.execute("UPDATE cache SET video_id = ?, timestamp = ? WHERE url = ?", (video_id, time.time(), url))
-        if audio_id:
-            await con.execute("UPDATE cache SET audio_id = ?, timestamp = ? WHERE url = ?", (audio_id, time.time(), url))
-        if caption:
-            await con.execute("UPDATE cache SET caption = ?, timestamp = ? WHERE url = ?", (caption, time.time(), url))
-        if photos:
-            await con.execute("UPDATE cache SET photos = ?, timestamp = ? WHERE url = ?", (json.dumps(photos), time.time(), url))
-            
-        await con.commit()
+    def save(self, chat_id, settings):
+        self.dirty[chat_id] = settings
+        self.cache.set(chat_id, settings)
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(SETTINGS_FLUSH_DELAY)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        try:
+            await self.store.con.executemany(self.UPSERT_SQL, [(chat_id, json.dumps(value)) for chat_id, value in batch.items()])
+            await self.store.con.commit()
+        except Exception as e:
+            logging.error(f"Error saving settings: {e}")
+            self.dirty = {**batch, **self.dirty}
+
+    async def close(self):
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+
+settings_store = SettingsStore(cache_store, SETTINGS_CACHE_SIZE)
+
+class JobQueue:
+    """Durable download jobs shared by a front process and any number of workers."""
+
+    # round-robin across chats (a job's place in its chat's lane comes first), and
+    # never a second job for a link that is being downloaded: it waits for the
+    # first one and is then served from the cache
+    CLAIM_SQL = """
+        UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1
+        WHERE id = (
+            SELECT id FROM (
+                SELECT id, cache_key, state, available_at, lease_until,
+                       ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS lane_position
+                FROM jobs WHERE platform = ?
+            ) AS j
+            WHERE ((state = 'pending' AND available_at <= ?) OR (state = 'running' AND lease_until < ?))
+              AND NOT EXISTS (
+                  SELECT 1 FROM jobs AS r
+                  WHERE r.cache_key = j.cache_key AND r.id != j.id AND r.state = 'running' AND r.lease_until >= ?
+              )
+            ORDER BY lane_position, id LIMIT 1
+        )
+        RETURNING id, platform, payload, attempts
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    async def open(self):
+        await self.store.con.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                platform TEXT,
+                payload TEXT,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL,
+                created REAL,
+                chat_id INTEGER,
+                cache_key TEXT
+            )
+        """)
+        for column in ("chat_id INTEGER", "cache_key TEXT"):
+            try:
+                await self.store.con.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            except Exception:
+                pass
+        await self.store.con.execute("CREATE INDEX IF NOT EXISTS jobs_platform ON jobs (platform, state)")
+        await self.store.con.execute("CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key)")
+        await self.store.con.commit()
+
+    async def put(self, platform, payload):
+        async with self.store.con.execute("SELECT COUNT(*) FROM jobs WHERE platform = ? AND state = 'pending'", (platform,)) as cur:
+            if (await cur.fetchone())[0] >= QUEUE_LIMIT:
+                raise QueueFull(platform)
+        now = time.time()
+        await self.store.con.execute(
+            "INSERT INTO jobs (platform, payload, available_at, created, chat_id, cache_key) VALUES (?, ?, ?, ?, ?, ?)",
+            (platform, json.dumps(payload), now, now, payload['chat_id'], payload['cache_key'])
+        )
+        await self.store.con.commit()
+
+    async def claim(self, platform, worker):
+        now = time.time()
+        async with self.store.con.execute(self.CLAIM_SQL, (worker, now + JOB_LEASE, platform, now, now, now)) as cur:
+            row = await cur.fetchone()
+        await self.store.con.commit()
+        if row:
+            return {'id': row[0], 'platform': row[1], 'payload': json.loads(row[2]), 'attempts': row[3]}
+        return None
+
+    async def renew(self, job_id, worker):
+        await self.store.con.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?", (time.time() + JOB_LEASE, job_id, worker))
+        await self.store.con.commit()
+
+    async def retry(self, job_id, delay):
+        await self.store.con.execute(
+            "UPDATE jobs SET state = 'pending', worker = NULL, available_at = ? WHERE id = ?",
+            (time.time() + delay, job_id)
+        )
+        await self.store.con.commit()
+
+    async def finish(self, job_id):
+        await self.store.con.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        await self.store.con.commit()
+
+jobs = JobQueue(cache_store)
+
+async def get_settings(chat_id):
+    return await settings_store.get(chat_id)
+
+class YtdlpEngine:
+    """Runs ytdlp_worker requests either in threads or in a pool of worker processes."""
+
+    STAGES = {'resolve': "resolve_via_ytdlp", 'meta': "get_meta_info", 'audio': "download_audio_force", 'video': "download_video"}
+
+    def __init__(self, backend, processes):
+        self.backend = backend
+        self.processes = processes
+        self.pool = None
+
+    def start(self):
+        if self.backend == "process":
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=ytdlp_worker.init_worker
+            )
+
+    def stop(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def restart(self, broken_pool):
+        if self.pool is broken_pool:
+            logging.error("yt-dlp worker pool crashed, restarting it")
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            self.start()
+
+    async def run(self, op, url, save_dir=None, info=None, max_bytes=None):
+        request = ytdlp_worker.YtdlpRequest(op, url, save_dir, info, max_bytes)
+        with metrics.span(self.STAGES[op]):
+            if self.pool is None:
+                response = await asyncio.to_thread(ytdlp_worker.handle, request)
+            else:
+                loop = asyncio.get_running_loop()
+                pool = self.pool
+                try:
+                    response = await loop.run_in_executor(pool, ytdlp_worker.handle, request)
+                except BrokenProcessPool:
+                    metrics.inc("ytdlp_worker_crashes_total")
+                    self.restart(pool)
+                    response = await loop.run_in_executor(self.pool, ytdlp_worker.handle, request)
+        if not response.ok:
+            raise ytdlp_worker.YtdlpError(response.error, response.error_type)
+        return response.value
+
+ytdlp = YtdlpEngine(YTDLP_BACKEND, YTDLP_PROCESSES)
+
+ErrorClass = namedtuple("ErrorClass", "kind transient ttl text")
+
+# failures on our side (format selection, ffmpeg) that say nothing about the post itself
+LOCAL_ERRORS = re.compile(r"requested format|ffmpeg|ffprobe|postprocess", re.I)
+
+# checked in order, against "<exception type>: <message>" of yt-dlp and gallery-dl errors;
+# throttling comes first, Instagram reports it as "not available, rate-limit reached or login required"
+ERROR_RULES = [
+    (re.compile(r"\b429\b|too many requests|rate.?limit", re.I),
+     ErrorClass("rate_limited", True, 60, "🚦 The platform is throttling us, please try again in a few minutes.")),
+    (re.compile(r"timed? ?out|connection (?:reset|refused|aborted)|temporary failure|HTTP Error 5\d\d|\b50[234]\b|remote end closed|IncompleteRead", re.I),
+     ErrorClass("network", True, 30, "🌐 Couldn't reach the platform, please try again later.")),
+    (re.compile(r"not available in your country|geo.?restrict|blocked in your (?:country|region)", re.I),
+     ErrorClass("geo_blocked", False, 21600, "🌍 This post is blocked in the bot's region.")),
+    (re.compile(r"private|sign in|log ?in|login required|members.only|age.restricted|confirm your age|Authori[sz]ation|AuthRequired", re.I),
+     ErrorClass("private", False, 21600, "🔒 This post is private or needs an account to view.")),
+    (re.compile(r"unsupported url|no video formats found|no video could be found", re.I),
+     ErrorClass("unsupported", False, 86400, "❌ There is nothing to download at this link.")),
+    (re.compile(r"unavailable|not available|removed|deleted|does not exist|not found|HTTP Error 404|NotFoundError|status code 10204", re.I),
+     ErrorClass("unavailable", False, 21600, "❌ This post is unavailable or was deleted.")),
+]
+
+def classify_error(error):
+    """Map a yt-dlp/gallery-dl failure to an ErrorClass, or None if it is unexpected."""
+    if not isinstance(error, (ytdlp_worker.YtdlpError, gallery_dl.exception.GalleryDLException)):
+        return None
+    text = f"{getattr(error, 'error_type', None) or type(error).__name__}: {error}"
+    if LOCAL_ERRORS.search(text):
+        return None
+    for pattern, error_class in ERROR_RULES:
+        if pattern.search(text):
+            return error_class
+    return None
+
+class Backoff:
+    """Per-platform exponential backoff with jitter after transient extractor errors."""
+
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.failures = {}
+        self.until = {}
+
+    async def wait(self, key):
+        while key in self.until:
+            remaining = self.until[key] - time.monotonic()
+            if remaining <= 0:
+                self.until[key] = time.monotonic() + self.base
+                return
+            await asyncio.sleep(remaining)
+
+    def failure(self, key):
+        attempt = self.failures.get(key, 0)
+        self.failures[key] = attempt + 1
+        delay = min(self.cap, self.base * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.until[key] = max(self.until.get(key, 0), time.monotonic() + delay)
+        return delay
+
+    def success(self, key):
+        self.failures.pop(key, None)
+        self.until.pop(key, None)
 
-def get_settings(user_id):
-    if user_id not in user_settings:
-        user_settings[user_id] = DEFAULT_SETTINGS.copy()
-    return user_settings[user_id]
+backoff = Backoff(2, 60)
+
+DOWNLOAD_FAILED = ErrorClass("failed", False, 300, "❌ Download failed, please try again later.")
+ERROR_CLASSES = {error_class.kind: error_class for _, error_class in ERROR_RULES}
+ERROR_CLASSES[DOWNLOAD_FAILED.kind] = DOWNLOAD_FAILED
+
+class FailureStore:
+    """Negative results in the cache database, so every process sees them."""
+
+    def __init__(self, store):
+        self.store = store
+        self.cache = TTLCache(4096, 600)
+
+    async def open(self):
+        await self.store.con.execute("CREATE TABLE IF NOT EXISTS failures (key TEXT PRIMARY KEY, kind TEXT, expires REAL)")
+        await self.store.con.commit()
+
+    async def get(self, key):
+        error_class = self.cache.get(key)
+        if error_class is None:
+            now = time.time()
+            async with self.store.con.execute("SELECT kind, expires FROM failures WHERE key = ? AND expires > ?", (key, now)) as cur:
+                row = await cur.fetchone()
+            if row and row[0] in ERROR_CLASSES:
+                error_class = ERROR_CLASSES[row[0]]
+                self.cache.set(key, error_class, ttl=row[1] - now)
+        return error_class
+
+    async def set(self, key, error_class):
+        now = time.time()
+        self.cache.set(key, error_class, ttl=error_class.ttl)
+        await self.store.con.execute("DELETE FROM failures WHERE expires <= ?", (now,))
+        await self.store.con.execute(
+            "INSERT OR REPLACE INTO failures (key, kind, expires) VALUES (?, ?, ?)",
+            (key, error_class.kind, now + error_class.ttl)
+        )
+        await self.store.con.commit()
+
+failure_store = FailureStore(cache_store)
+
+async def run_with_backoff(op, url, **kwargs):
+    """ytdlp.run, retrying transient errors up to YTDLP_RETRIES times."""
+    platform = get_platform(url)
+    for attempt in range(YTDLP_RETRIES + 1):
+        await backoff.wait(platform)
+        try:
+            result = await ytdlp.run(op, url, **kwargs)
+        except ytdlp_worker.YtdlpError as e:
+            error_class = classify_error(e)
+            if not (error_class and error_class.transient):
+                # not throttling: the platform answered and the error is about this link
+                backoff.success(platform)
+                raise
+            if attempt == YTDLP_RETRIES:
+                raise
+            delay = backoff.failure(platform)
+            metrics.inc("retries_total", platform=platform, kind=error_class.kind)
+            logging.warning(f"{op} of {url} failed ({error_class.kind}), retrying in {delay:.1f}s")
+        else:
+            backoff.success(platform)
+            return result
+
+http_session = None
+
+def get_http_session():
+    """Application-wide aiohttp session with keep-alive and a DNS cache."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_CONNECTIONS, limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=60)
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
+        )
+    return http_session
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
 
 async def get_real_url(short_url):
+    real_url = url_cache.get(short_url)
+    if real_url is None:
+        with metrics.span("get_real_url"):
+            real_url = await resolve_real_url(short_url)
+        # a failed resolution is only remembered briefly so it gets retried soon
+        url_cache.set(short_url, real_url, ttl=60 if real_url == short_url else None)
+    return real_url
+
+async def resolve_real_url(short_url):
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
-        async with aiohttp.ClientSession() as session:
-            async with session.head(short_url, headers=headers, allow_redirects=True, timeout=5) as response:
-                res_url = str(response.url)
-                if "/photo/" in res_url or "/video/" in res_url:
-                    return res_url
+        async with get_http_session().head(short_url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            res_url = str(response.url)
+            if "/photo/" in res_url or "/video/" in res_url:
+                return res_url
     except Exception:
         pass
 
-    def resolve_via_ytdlp():
-        ydl_opts = {'quiet': True, 'extract_flat': True}
+    real_url, info = await ytdlp.run('resolve', short_url)
+    if info:
+        # spare fetch_meta_info a second extraction of the same video
+        meta_cache.set(real_url, info)
+    return real_url
+
+class GalleryJob(gallery_dl.job.DownloadJob):
+    """In-process gallery-dl download into one directory."""
+
+    def __init__(self, url, parent=None, save_dir=None, on_file=None, on_metadata=None):
+        # gallery-dl builds child jobs (e.g. for vm.tiktok.com links) as GalleryJob(extractor, parent)
+        gallery_dl.job.DownloadJob.__init__(self, url, parent)
+        self.root = parent.root if parent else self
+        if parent:
+            save_dir, on_file, on_metadata = parent.save_dir, parent.on_file, parent.on_metadata
+        self.save_dir = save_dir
+        self.on_file = on_file
+        self.on_metadata = on_metadata
+        self.files = parent.files if parent else []
+        self.metadata = None
+        self.cancelled = False
+        self.error = None
+        self.out = self
+
+        overrides = {"base-directory": save_dir, "directory": ()}
+        extractor_config = self.extractor.config
+        self.extractor.config = lambda key, default=None: overrides[key] if key in overrides else extractor_config(key, default)
+
+    def dispatch(self, extractor):
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(short_url, download=False)
-                return info.get('webpage_url', info.get('url', short_url))
-        except Exception:
-            pass
-        return short_url
+            return gallery_dl.job.DownloadJob.dispatch(self, extractor)
+        except Exception as e:
+            self.root.error = e
+            raise
 
-    return await asyncio.to_thread(resolve_via_ytdlp)
+    def handle_directory(self, kwdict):
+        root = self.root
+        if root.metadata is None:
+            root.metadata = {k: v for k, v in kwdict.items() if not k.startswith('_')}
+            if self.on_metadata: self.on_metadata(root.metadata)
+        gallery_dl.job.DownloadJob.handle_directory(self, kwdict)
 
-async def download_gallery(url, save_dir):
-    abs_save_dir = os.path.abspath(save_dir)
-    
-    cmd = ["gallery-dl", "--directory", abs_save_dir, "--write-info-json", "--no-mtime", url]
-    
+    def handle_url(self, url, kwdict):
+        if self.root.cancelled:
+            raise gallery_dl.exception.StopExtraction()
+        gallery_dl.job.DownloadJob.handle_url(self, url, kwdict)
+
+    # output interface, called by DownloadJob for every finished or existing file
+    def start(self, path):
+        pass
+
+    def skip(self, path):
+        self.success(path)
+
+    def success(self, path):
+        self.files.append(path)
+        if self.on_file: self.on_file(path)
+
+    def progress(self, bytes_total, bytes_downloaded, bytes_per_second):
+        pass
+
+gallery_pool = None
+
+def get_gallery_pool():
+    """gallery-dl config and thread pool, set up on first use instead of at import."""
+    global gallery_pool
+    if gallery_pool is None:
+        gallery_dl.config.load()
+        gallery_dl.config.set(("downloader",), "mtime", False)
+        gallery_pool = ThreadPoolExecutor(max_workers=GALLERY_WORKERS, thread_name_prefix="gallery-dl")
+    return gallery_pool
+
+async def download_gallery(url, save_dir, on_file=None, on_metadata=None):
+    """Run a GalleryJob on the gallery-dl pool; callbacks are delivered on the event loop."""
+    loop = asyncio.get_running_loop()
+    job = None
+
+    def threadsafe(callback):
+        return (lambda value: loop.call_soon_threadsafe(callback, value)) if callback else None
+
+    try:
+        pool = get_gallery_pool()
+        job = GalleryJob(url, save_dir=os.path.abspath(save_dir), on_file=threadsafe(on_file), on_metadata=threadsafe(on_metadata))
+        with metrics.span("download_gallery"):
+            status = await loop.run_in_executor(pool, job.run)
+        metrics.inc("bytes_downloaded_total", sum(os.path.getsize(f) for f in job.files if os.path.isfile(f)))
+        if status != 0 and not job.files:
+            error_class = classify_error(job.error)
+            if error_class and error_class.transient:
+                # don't fall back to yt-dlp against a platform that is already throttling us
+                raise job.error
+            logging.error(f"❌ Gallery-dl failed with status {status} for {url}")
+            return False, job.metadata
+    except asyncio.CancelledError:
+        if job: job.cancelled = True
+        raise
+    except Exception as e:
+        if job and e is job.error:
+            raise
+        logging.error(f"Gallery-dl error: {e}")
+        return False, None
+
+    media_files = [f for f in job.files if f.lower().endswith(('.jpg', '.png', '.webp', '.mp4', '.mp3'))]
+    return len(media_files) > 0, job.metadata
+
+def gallery_caption(data):
+    """Build (caption, track_title, track_artist) from gallery-dl post metadata."""
     caption = ""
     track_title = "Original Audio"
     track_artist = "Bot"
 
     try:
+        if isinstance(data, list):
+            data = data[0] if data else {}
+
+        if isinstance(data, dict) and data:
+            user_field = data.get('user')
+            author_raw = "User"
+
+            if isinstance(user_field, dict):
+                author_raw = (user_field.get('nickname') or 
+                              user_field.get('unique_id') or 
+                              user_field.get('name') or 
+                              "User")
+            elif isinstance(user_field, str):
+                author_raw = user_field
+            else:
+                author_raw = (data.get('username') or 
+                              data.get('author', {}).get('name') or 
+                              data.get('nick') or 
+                              "User")
+            
+            author = html.escape(str(author_raw))
+
+            desc_raw = (data.get('title') or 
+                        data.get('desc') or 
+                        data.get('description') or 
+                        data.get('caption') or 
+                        data.get('text') or 
+                        "")
+            
+            desc = html.escape(str(desc_raw).strip())
+            if len(desc) > 800: desc = desc[:800] + "..."
+            
+            if desc:
+                caption = f"<blockquote expandable><b>{author}</b>\n\n{desc}</blockquote>"
+            else:
+                caption = f"<b>{author}</b>"
+
+            music_obj = data.get('music') or {}
+            
+            track_title = (music_obj.get('title') or 
+                           data.get('track', {}).get('name') or 
+                           "Original Audio")
+            
+            track_artist = (music_obj.get('authorName') or
+                            music_obj.get('author') or 
+                            music_obj.get('artist') or 
+                            data.get('track', {}).get('artist') or 
+                            author)
+
+    except Exception as e:
+        logging.error(f"Metadata structure error: {e}", exc_info=True)
+
+    return caption, track_title, track_artist
+
+async def run_ffmpeg(*args, tool="ffmpeg"):
+    with metrics.span(tool):
         proc = await asyncio.create_subprocess_exec(
-            *cmd,
+            tool, *args,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
         stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', errors='ignore').strip() or f"{tool} exited with {proc.returncode}")
+    return stdout.decode('utf-8', errors='ignore').strip()
 
-        if proc.returncode != 0:
-            err = stderr.decode('utf-8', errors='ignore') or stdout.decode('utf-8', errors='ignore')
-            logging.error(f"❌ Gallery-dl failed: {err}")
-            return False, "", "", ""
-
-        if os.path.exists(abs_save_dir):
-            json_file = next((os.path.join(abs_save_dir, f) for f in os.listdir(abs_save_dir) if f.endswith('.json')), None)
-            
-            if json_file:
-                try:
-                    with open(json_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    
-                    if isinstance(data, list):
-                        data = data[0] if data else {}
-
-                    if isinstance(data, dict):
-                        user_field = data.get('user')
-                        author_raw = "User"
-
-                        if isinstance(user_field, dict):
-                            author_raw = (user_field.get('nickname') or 
-                                          user_field.get('unique_id') or 
-                                          user_field.get('name') or 
-                                          "User")
-                        elif isinstance(user_field, str):
-                            author_raw = user_field
-                        else:
-                            author_raw = (data.get('username') or 
-                                          data.get('author', {}).get('name') or 
-                                          data.get('nick') or 
-                                          "User")
-                        
-                        author = html.escape(str(author_raw))
-
-                        desc_raw = (data.get('title') or 
-                                    data.get('desc') or 
-                                    data.get('description') or 
-                                    data.get('caption') or 
-                                    data.get('text') or 
-                                    "")
-                        
-                        desc = html.escape(str(desc_raw).strip())
-                        if len(desc) > 800: desc = desc[:800] + "..."
-                        
-                        if desc:
-                            caption = f"<blockquote expandable><b>{author}</b>\n\n{desc}</blockquote>"
-                        else:
-                            caption = f"<b>{author}</b>"
-
-                        music_obj = data.get('music') or {}
-                        
-                        track_title = (music_obj.get('title') or 
-                                       data.get('track', {}).get('name') or 
-                                       "Original Audio")
-                        
-                        track_artist = (music_obj.get('authorName') or
-                                        music_obj.get('author') or 
-                                        music_obj.get('artist') or 
-                                        data.get('track', {}).get('artist') or 
-                                        author)
-
-                except Exception as e:
-                    logging.error(f"JSON structure error: {e}", exc_info=True)
+async def derive_audio(src_path, save_dir):
+    """Take the audio track out of an already downloaded media file."""
+    try:
+        codec = await run_ffmpeg("-v", "error", "-select_streams", "a:0", "-show_entries", "stream=codec_name",
+                                 "-of", "default=noprint_wrappers=1:nokey=1", src_path, tool="ffprobe")
+        if not codec:
+            return None
+        ext = {"aac": "m4a", "mp3": "mp3"}.get(codec)
+        if ext and src_path.lower().endswith("." + ext):
+            return src_path
 
+        audio_path = os.path.join(save_dir, f"audio.{ext or 'mp3'}")
+        codec_args = ["-c:a", "copy"] if ext else ["-c:a", "libmp3lame", "-b:a", "192k"]
+        await run_ffmpeg("-y", "-v", "error", "-i", src_path, "-vn", "-map", "0:a:0", *codec_args, audio_path)
+        return audio_path
     except Exception as e:
-        logging.error(f"Exec error: {e}")
+        logging.error(f"Audio extraction error: {e}")
+        return None
 
-    if os.path.exists(abs_save_dir):
-        media_files = [f for f in os.listdir(abs_save_dir) if f.lower().endswith(('.jpg', '.png', '.webp', '.mp4', '.mp3'))]
-        if len(media_files) > 0:
-            return True, caption, track_title, track_artist
-            
-    return False, "", "Original Audio", "Bot"
-
-def download_audio_force(url, save_dir):
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': f'{save_dir}/audio.%(ext)s',
-        'postprocessors': [{'key': 'FFmpegExtractAudio','preferredcodec': 'mp3','preferredquality': '192'}],
-        'noplaylist': True, 'quiet': True,
-        'concurrent_fragment_downloads': 5,
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+async def prepare_upload(path, save_dir, info):
+    """Make a downloaded video streamable and small enough for a bot upload."""
+    if not (info or {}).get('requested_formats'):
+        remuxed = os.path.join(save_dir, "faststart.mp4")
         try:
-            ydl.download([url])
-            return True
+            await run_ffmpeg("-y", "-v", "error", "-i", path, "-map", "0", "-c", "copy", "-movflags", "+faststart", remuxed)
+            path = remuxed
         except Exception as e:
-            logging.error(f"Audio DL error: {e}")
-            return False
-
-def download_video(url, save_dir):
-    ydl_opts = {
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-        'outtmpl': f'{save_dir}/video.%(ext)s',
-        'noplaylist': True, 'quiet': True,
-        'concurrent_fragment_downloads': 5,
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        return ydl.prepare_filename(info), info
+            logging.warning(f"Faststart remux failed, uploading as is: {e}")
 
-def get_meta_info(url):
-    ydl_opts = {'quiet': True, 'noplaylist': True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            return ydl.extract_info(url, download=False)
-        except:
+    if os.path.getsize(path) <= MAX_UPLOAD_BYTES:
+        return path
+    if not REENCODE_OVERSIZE:
+        return None
+    return await reencode_to_fit(path, save_dir, (info or {}).get('duration'))
+
+async def reencode_to_fit(path, save_dir, duration):
+    """Re-encode to H.264/AAC at the bitrate that fits MAX_UPLOAD_BYTES, capped at 720p."""
+    try:
+        if not duration:
+            duration = float(await run_ffmpeg("-v", "error", "-show_entries", "format=duration",
+                                              "-of", "default=noprint_wrappers=1:nokey=1", path, tool="ffprobe"))
+        video_kbps = int(MAX_UPLOAD_BYTES * 8 / 1000 / duration * 0.95) - 128
+        if video_kbps < 150:
+            logging.warning(f"{path} is too long to fit into {MAX_UPLOAD_BYTES} bytes at a watchable bitrate")
             return None
 
-def get_settings_kb(user_id):
-    s = get_settings(user_id)
+        out_path = os.path.join(save_dir, "reencoded.mp4")
+        await run_ffmpeg(
+            "-y", "-v", "error", "-i", path,
+            "-vf", "scale=-2:'min(720,ih)'",
+            "-c:v", "libx264", "-preset", "veryfast",
+            "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{2 * video_kbps}k",
+            "-c:a", "aac", "-b:a", "128k",
+            "-movflags", "+faststart",
+            out_path
+        )
+        return out_path if os.path.getsize(out_path) <= MAX_UPLOAD_BYTES else None
+    except Exception as e:
+        logging.error(f"Re-encode error: {e}")
+        return None
+
+async def fetch_meta_info(url):
+    info = meta_cache.get(url)
+    if info is None:
+        info = await run_with_backoff('meta', url)
+        if info:
+            meta_cache.set(url, info)
+    return info
+
+def build_caption(info):
+    author = html.escape(info.get('uploader') or 'User')
+    desc = html.escape(info.get('description', '') or info.get('title', ''))
+    if len(desc) > 800: desc = desc[:800] + "..."
+    return f"<blockquote expandable><b>{author}</b>\n\n{desc}</blockquote>"
+
+async def get_settings_kb(user_id):
+    s = await get_settings(user_id)
     kb = [
         [InlineKeyboardButton(f"🎵 Add audio to photos: {'✅' if s['audio'] else '❌'}", callback_data="set_audio")],
         [InlineKeyboardButton(f"📝 Add description: {'✅' if s['desc'] else '❌'}", callback_data="set_desc")],
@@ -285,17 +1138,18 @@ def get_settings_kb(user_id):
 
 @app.on_message(filters.command("settings"))
 async def settings_handler(client, message):
-    await message.reply("⚙️ <b>Download settings:</b>", reply_markup=get_settings_kb(message.chat.id))
+    kb = await get_settings_kb(message.chat.id)
+    await governor.send("reply", message.chat.id, lambda: message.reply("⚙️ <b>Download settings:</b>", reply_markup=kb))
 
 @app.on_callback_query(filters.regex("^set_"))
 async def callback_handler(client, callback):
     chat_id = callback.message.chat.id
     action = callback.data.split("_")[1]
-    s = get_settings(chat_id)
+    s = await get_settings(chat_id)
     
     if action == "close":
         try:
-            await callback.message.delete()
+            await governor.send("delete_message", chat_id, callback.message.delete, cost=0)
         except:
             pass
         return
@@ -304,9 +1158,10 @@ async def callback_handler(client, callback):
     elif action == "sep": s['sep_desc'] = not s['sep_desc']
     elif action == "link": s['link_btn'] = not s['link_btn']
 
-    save_settings_to_file()
+    settings_store.save(chat_id, s)
     
-    await callback.message.edit_reply_markup(get_settings_kb(chat_id))
+    kb = await get_settings_kb(chat_id)
+    await governor.send("edit_reply_markup", chat_id, lambda: callback.message.edit_reply_markup(kb))
 
 @app.on_message(filters.command("start"))
 async def start_handler(client, message):
@@ -319,200 +1174,702 @@ async def start_handler(client, message):
         "Just send me a link!\n\n"
         "To change preferences just type /settings"
     )
-    await message.reply(text)
+    await governor.send("reply", message.chat.id, lambda: message.reply(text))
+
+@app.on_message(filters.command("stats") & filters.user(getattr(config, 'OWNER_ID', [])))
+async def stats_handler(client, message):
+    hits = metrics.counter("cache_hits_total")
+    misses = metrics.counter("cache_misses_total")
+    lines = [
+        "📊 <b>Stats</b>\n",
+        f"Uptime: {int(time.time() - metrics.started) // 60} min",
+        f"Requests: {sum(v for (name, _), v in metrics.counters.items() if name == 'requests_total')}",
+        f"Cache hits: {hits}/{hits + misses}" + (f" ({hits / (hits + misses):.0%})" if hits + misses else ""),
+        f"Expired file_ids: {metrics.counter('cache_file_id_expired_total')}",
+        f"Downloaded: {format_size(metrics.counter('bytes_downloaded_total'))}",
+        f"Uploaded: {format_size(metrics.counter('bytes_uploaded_total'))}\n",
+        "<b>Stage</b>: count · p50 · p95 · max",
+    ]
+    for stage, stat in sorted(metrics.stages.items()):
+        lines.append(f"<code>{stage}</code>: {stat['count']} · {metrics.quantile(stage, 0.5):.2f}s · {metrics.quantile(stage, 0.95):.2f}s · {stat['max']:.2f}s")
+    await governor.send("reply", message.chat.id, lambda: message.reply("\n".join(lines), parse_mode=enums.ParseMode.HTML))
+
+class SingleFlight:
+    """Registry of downloads in progress, keyed by resolved URL."""
+
+    def __init__(self):
+        self.flights = {}
+
+    def claim(self, key):
+        """Return None if the caller should download key itself, otherwise the future of the running download."""
+        running = self.flights.get(key)
+        if running is not None:
+            return running
+        self.flights[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def release(self, key):
+        running = self.flights.pop(key, None)
+        if running is not None and not running.done():
+            running.set_result(None)
+
+inflight = SingleFlight()
+
+async def send_cached(client, message, cached_data, settings, default_buttons):
+    if cached_data.get('photos'):
+        file_ids = cached_data['photos']
+        cap = cached_data['caption'] if cached_data['caption'] else ""
+        for i in range(0, len(file_ids), 10):
+            chunk = file_ids[i:i + 10]
+            media_group = [InputMediaPhoto(fid, caption=cap if (i==0 and idx==0 and not settings['sep_desc']) else "", parse_mode=enums.ParseMode.HTML) for idx, fid in enumerate(chunk)]
+            await governor.send("send_media_group", message.chat.id, lambda: client.send_media_group(message.chat.id, media=media_group, reply_parameters=ReplyParameters(message_id=message.id)), cost=len(media_group))
+        if cached_data.get('audio') and settings['audio']:
+            try:
+                await governor.send("send_audio", message.chat.id, lambda: client.send_audio(message.chat.id, cached_data['audio'], title=cached_data['audio_title'], performer=cached_data['audio_performer'], reply_parameters=ReplyParameters(message_id=message.id)))
+            except Exception as e:
+                metrics.inc("cache_file_id_expired_total")
+                logging.warning(f"Cached audio expired: {e}")
+        if settings['desc'] and settings['sep_desc'] and cap:
+            await governor.send("reply", message.chat.id, lambda: message.reply(cap, reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML))
+        return True
+
+    elif cached_data.get('video'):
+        try:
+            vid_cap = cached_data['caption'] if (cached_data['caption'] and not settings['sep_desc']) else ""
+            vid_btn = default_buttons if not settings['sep_desc'] else None
+            await governor.send("send_video", message.chat.id, lambda: client.send_video(message.chat.id, video=cached_data['video'], caption=vid_cap, reply_markup=vid_btn, reply_parameters=ReplyParameters(message_id=message.id), parse_mode=enums.ParseMode.HTML))
+            if settings['desc'] and settings['sep_desc'] and cached_data['caption']:
+                await governor.send("reply", message.chat.id, lambda: message.reply(cached_data['caption'], reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML))
+            return True
+        except Exception as e:
+            metrics.inc("cache_file_id_expired_total")
+            logging.warning(f"Cache expired: {e}")
+
+    elif cached_data.get('audio'):
+        try:
+            await governor.send("send_audio", message.chat.id, lambda: client.send_audio(message.chat.id, cached_data['audio'], title=cached_data['audio_title'], performer=cached_data['audio_performer'], reply_markup=default_buttons, reply_parameters=ReplyParameters(message_id=message.id)))
+            return True
+        except Exception as e:
+            metrics.inc("cache_file_id_expired_total")
+            logging.warning(f"Cache expired: {e}")
+
+    return False
+
+async def process_gallery(client, message, status, settings, real_url, cache_key, save_dir, default_buttons):
+    """Download a TikTok post with gallery-dl and upload it."""
+    files = asyncio.Queue()
+    metadata = {}
+    download = asyncio.create_task(download_gallery(real_url, save_dir, on_file=files.put_nowait, on_metadata=metadata.update))
+    download.add_done_callback(lambda _: files.put_nowait(None))
+
+    photos, uploaded_file_ids = [], []
+    video_file = audio_file = audio_task = meta = None
+    sent = 0
+
+    def get_meta():
+        nonlocal meta
+        if meta is not None:
+            return meta
+        caption, meta_title, meta_artist = gallery_caption(metadata)
+        parsed = (caption if settings['desc'] else "", meta_title, meta_artist)
+        # metadata arrives before the first file, but don't pin defaults if it is missing
+        if metadata or download.done():
+            meta = parsed
+        return parsed
+
+    async def send_photos(chunk, first):
+        caption = get_meta()[0]
+        media_group = [InputMediaPhoto(p, caption=caption if (first and idx==0 and not settings['sep_desc']) else "", parse_mode=enums.ParseMode.HTML) for idx, p in enumerate(chunk)]
+        msgs = await governor.send("send_media_group", message.chat.id, lambda: client.send_media_group(message.chat.id, media=media_group, reply_parameters=ReplyParameters(message_id=message.id)), upload=chunk, cost=len(media_group))
+        uploaded_file_ids.extend([m.photo.file_id for m in msgs if m.photo])
+
+    async def send_track(path):
+        # cached together with the photos: an audio-only row would be served as just the song
+        _, meta_title, meta_artist = get_meta()
+        sent_audio = await governor.send("send_audio", message.chat.id, lambda: client.send_audio(message.chat.id, path, title=meta_title, performer=meta_artist, reply_parameters=ReplyParameters(message_id=message.id)), upload=[path])
+        return {'audio_id': sent_audio.audio.file_id, 'audio_title': meta_title, 'audio_performer': meta_artist} if sent_audio.audio else {}
+
+    try:
+        while True:
+            path = await files.get()
+            if path is None:
+                break
+            lower = path.lower()
+            if lower.endswith(('.jpg', '.png', '.webp')):
+                if not photos: await governor.edit_status(status, "🔄️ Uploading...")
+                photos.append(path)
+            elif lower.endswith(('.mp3', '.m4a')):
+                audio_file = path
+            elif lower.endswith('.mp4'):
+                video_file = path
+
+            if photos and audio_file and settings['audio'] and audio_task is None:
+                audio_task = asyncio.create_task(send_track(audio_file))
+            while len(photos) - sent >= 10:
+                await send_photos(photos[sent:sent + 10], sent == 0)
+                sent += 10
+    except BaseException:
+        download.cancel()
+        if audio_task: audio_task.cancel()
+        raise
+
+    success, _ = download.result()
+    if not success and not uploaded_file_ids:
+        return False
+
+    caption = get_meta()[0]
+    if photos:
+        if len(photos) > sent:
+            await send_photos(photos[sent:], sent == 0)
+        if settings['audio'] and audio_task is None:
+            if not audio_file and video_file:
+                audio_file = await derive_audio(video_file, save_dir)
+            if audio_file:
+                audio_task = asyncio.create_task(send_track(audio_file))
+        audio = await audio_task if audio_task else {}
+        if success and uploaded_file_ids: await update_cache(cache_key, photos=uploaded_file_ids, caption=caption, **audio)
+
+    elif video_file:
+        await governor.edit_status(status, "🔄️ Uploading...")
+        vid_cap = caption if not settings['sep_desc'] else ""
+        vid_btn = default_buttons if not settings['sep_desc'] else None
+        sent_msg = await governor.send("send_video", message.chat.id, lambda: client.send_video(message.chat.id, video=video_file, caption=vid_cap, reply_markup=vid_btn, reply_parameters=ReplyParameters(message_id=message.id), parse_mode=enums.ParseMode.HTML), upload=[video_file])
+        if sent_msg.video: await update_cache(cache_key, video_id=sent_msg.video.file_id, caption=caption)
+
+    if settings['desc'] and settings['sep_desc'] and caption:
+        await governor.send("reply", message.chat.id, lambda: message.reply(caption, reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML))
+    
+    await governor.delete_status(status)
+    return True
+
+async def process_link(client, message, status, settings, platform, real_url, cache_key, save_dir, default_buttons):
+    is_tiktok = platform == "tiktok"
+    is_yt_music = platform == "music"
+
+    if is_tiktok:
+        if await process_gallery(client, message, status, settings, real_url, cache_key, save_dir, default_buttons):
+            return
+
+    info = await fetch_meta_info(real_url)
+    caption = build_caption(info) if info and settings['desc'] else ""
+
+    if is_yt_music:
+        meta_title = info.get('track') or info.get('title') or "Audio" if info else "Audio"
+        meta_artist = info.get('artist') or info.get('uploader') or "Bot" if info else "Bot"
+        
+        source_file = await run_with_backoff('audio', real_url, save_dir=save_dir, info=info)
+        if source_file and os.path.isfile(source_file): metrics.inc("bytes_downloaded_total", os.path.getsize(source_file))
+        audio_file = await derive_audio(source_file, save_dir) if source_file else None
+        if audio_file:
+            await governor.edit_status(status, "🔄️ Uploading...")
+            sent_audio = await governor.send("send_audio", message.chat.id, lambda: client.send_audio(message.chat.id, audio_file, title=meta_title, performer=meta_artist, reply_markup=default_buttons, reply_parameters=ReplyParameters(message_id=message.id)), upload=[audio_file])
+            if sent_audio.audio:
+                await update_cache(cache_key, audio_id=sent_audio.audio.file_id, audio_title=meta_title, audio_performer=meta_artist)
+            await governor.delete_status(status)
+        else:
+            await governor.edit_status(status, "❌ Audio download error.")
+
+    else:
+        vid_path, info = await run_with_backoff('video', real_url, save_dir=save_dir, info=info, max_bytes=MAX_UPLOAD_BYTES)
+        if info and settings['desc'] and not caption:
+            caption = build_caption(info)
+        
+        if vid_path and os.path.exists(vid_path):
+            metrics.inc("bytes_downloaded_total", os.path.getsize(vid_path))
+            vid_path = await prepare_upload(vid_path, save_dir, info)
+            if not vid_path:
+                await governor.edit_status(status, "❌ Video is too big to upload.")
+                return
+            await governor.edit_status(status, "🔄️ Uploading...")
+            vid_cap = caption if not settings['sep_desc'] else ""
+            vid_btn = default_buttons if not settings['sep_desc'] else None
+            
+            sent_msg = await governor.send("send_video", message.chat.id, lambda: client.send_video(
+                message.chat.id, 
+                video=vid_path, 
+                caption=vid_cap, 
+                reply_markup=vid_btn, 
+                reply_parameters=ReplyParameters(message_id=message.id), 
+                parse_mode=enums.ParseMode.HTML
+            ), upload=[vid_path])
+            
+            if sent_msg.video: 
+                await update_cache(cache_key, video_id=sent_msg.video.file_id, caption=caption)
+
+            if settings['desc'] and settings['sep_desc'] and caption:
+                await governor.send("reply", message.chat.id, lambda: message.reply(caption, reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML))
+
+            await governor.delete_status(status)
+        else:
+            await governor.edit_status(status, "❌ Video download error.")
+
+class QueueFull(Exception):
+    pass
+
+QUEUE_FULL_TEXT = "🚦 Too many downloads right now, please try again in a minute."
+
+class Scheduler:
+    """Bounded download queue with a fixed pool of workers per platform."""
+
+    POSITION_UPDATES = 5
+
+    def __init__(self, workers, limit):
+        self.workers = workers
+        self.limit = limit
+        self.queues = {platform: OrderedDict() for platform in workers}
+        self.pending = {platform: 0 for platform in workers}
+        self.idle = {platform: 0 for platform in workers}
+        self.wakeup = {}
+        self.tasks = []
+
+    def start(self):
+        for platform, count in self.workers.items():
+            self.wakeup[platform] = asyncio.Event()
+            for _ in range(count):
+                self.tasks.append(asyncio.create_task(self._worker(platform)))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, platform, chat_id, job, on_position=None):
+        if self.pending[platform] >= self.limit:
+            raise QueueFull(platform)
+        entry = {'job': job, 'future': asyncio.get_running_loop().create_future(), 'on_position': on_position, 'position': 0}
+        self.queues[platform].setdefault(chat_id, deque()).append(entry)
+        self.pending[platform] += 1
+        self.wakeup[platform].set()
+        if self.pending[platform] > self.idle[platform]:
+            self._report_positions(platform)
+        return await entry['future']
+
+    def _take(self, platform):
+        chats = self.queues[platform]
+        while chats:
+            chat_id, jobs = chats.popitem(last=False)
+            entry = jobs.popleft()
+            if jobs:
+                chats[chat_id] = jobs
+            self.pending[platform] -= 1
+            if not entry['future'].done():
+                return entry
+        return None
+
+    def _report_positions(self, platform):
+        order = []
+        lanes = [list(jobs) for jobs in self.queues[platform].values()]
+        depth = 0
+        while any(len(lane) > depth for lane in lanes):
+            order.extend(lane[depth] for lane in lanes if len(lane) > depth)
+            depth += 1
+        for position, entry in enumerate(order, 1):
+            self._notify(entry, position)
+
+    def _notify(self, entry, position):
+        if entry['on_position'] and entry['position'] != position and (entry['position'] == 0 or position <= self.POSITION_UPDATES):
+            entry['position'] = position
+            asyncio.create_task(entry['on_position'](position))
+
+    async def _worker(self, platform):
+        while True:
+            entry = self._take(platform)
+            if entry is None:
+                self.wakeup[platform].clear()
+                self.idle[platform] += 1
+                try:
+                    await self.wakeup[platform].wait()
+                finally:
+                    self.idle[platform] -= 1
+                continue
+            self._report_positions(platform)
+            self._notify(entry, 0)
+            try:
+                result = await entry['job']()
+            except asyncio.CancelledError:
+                if not entry['future'].done():
+                    entry['future'].cancel()
+                raise
+            except Exception as e:
+                if not entry['future'].done():
+                    entry['future'].set_exception(e)
+            else:
+                if not entry['future'].done():
+                    entry['future'].set_result(result)
+
+scheduler = Scheduler(PLATFORM_WORKERS, QUEUE_LIMIT)
+
+CANONICAL_PATTERNS = [
+    ("tiktok", re.compile(r"tiktok\.com/(?:@[\w.-]*/)?(?:video|photo|v)/(\d+)")),
+    ("ytmusic", re.compile(r"music\.youtube\.com/watch\?(?:.*&)?v=([\w-]{11})")),
+    ("youtube", re.compile(r"(?:youtube\.com/(?:shorts/|watch\?(?:.*&)?v=)|youtu\.be/)([\w-]{11})")),
+    ("instagram", re.compile(r"instagram\.com/(?:[\w.]+/)?(?:reels?|p|tv)/([\w-]+)")),
+]
+
+def canonical_key(url):
+    """Reduce a link to a stable content key (e.g. "tiktok:7301234567890123456"), or None if it has no content id."""
+    for platform, pattern in CANONICAL_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return f"{platform}:{match.group(1)}"
+    return None
+
+LINK_PATTERN = re.compile(r"(https?://(?:www\.)?[\w.-]*(?:tiktok\.com|instagram\.com|youtube\.com/shorts/|music\.youtube\.com).*[/\?][^\s]+)")
+
+def get_platform(url):
+    if "tiktok.com" in url:
+        return "tiktok"
+    if "music.youtube.com" in url:
+        return "music"
+    if "instagram.com" in url:
+        return "instagram"
+    return "shorts"
+
+async def resolve_link(raw_url):
+    """Return (platform, real_url, cache_key) for a link as the user pasted it."""
+    platform = get_platform(raw_url)
+    cache_key = canonical_key(raw_url)
+    if cache_key:
+        return platform, raw_url, cache_key
+    real_url = await get_real_url(raw_url)
+    if platform == "tiktok":
+        cache_key = canonical_key(real_url)
+        return platform, real_url if cache_key else raw_url, cache_key or raw_url
+    cache_key = canonical_key(real_url)
+    if cache_key and platform == "music":
+        # yt-dlp resolves music links to www.youtube.com; keep their audio rows apart from the videos
+        cache_key = cache_key.replace("youtube:", "ytmusic:", 1)
+    return platform, real_url, cache_key or real_url
+
+async def report_error(client, status, url, cache_key, e):
+    """Tell the user what went wrong; unexpected errors also go to the owner with a traceback (call from the except block)."""
+    error_class = classify_error(e)
+    if error_class:
+        logger.warning(f"{url} failed ({error_class.kind}): {e}")
+        metrics.inc("failures_total", kind=error_class.kind)
+        if error_class.transient:
+            backoff.failure(get_platform(url))
+        if cache_key:
+            await failure_store.set(cache_key, error_class)
+        await governor.edit_status(status, error_class.text)
+        return
+    logger.error(f"Error processing {url}: {e}")
+    error_text = str(e)
+    user_msg = (
+        "Uh-oh. Houston, we have a problem:\n"
+        f"<blockquote expandable>{html.escape(error_text)}</blockquote>"
+    )
+    await governor.edit_status(status, user_msg, parse_mode=enums.ParseMode.HTML)
+    if hasattr(config, 'OWNER_ID'):
+        tb_text = traceback.format_exc()
+        doc = io.BytesIO(tb_text.encode('utf-8'))
+        doc.name = "error_log.txt"
+        try:
+            owner_report = (
+                f"🚨 <b>Something happened...</b>\n"
+                f"<blockquote expandable>{html.escape(error_text)}</blockquote>\n"
+            )
+            await governor.send("send_document", config.OWNER_ID, lambda: client.send_document(config.OWNER_ID, document=doc, caption=owner_report, parse_mode=enums.ParseMode.HTML))
+        except Exception as owner_err:
+            logger.error(f"Failed to send log to owner: {owner_err}")
+
+def job_payload(message, status, settings, real_url, cache_key):
+    return {
+        'chat_id': message.chat.id,
+        'message_id': message.id,
+        'status_id': status.id,
+        'settings': settings,
+        'real_url': real_url,
+        'cache_key': cache_key,
+    }
+
+async def run_job(client, job):
+    """Worker side of link_handler: serve one claimed job and drop it from the queue."""
+    payload = job['payload']
+    chat_id, real_url, cache_key, settings = payload['chat_id'], payload['real_url'], payload['cache_key'], payload['settings']
+    # not get_platform(real_url): YT Music links are resolved to www.youtube.com
+    platform = job['platform']
+    save_dir = os.path.join(DOWNLOAD_PATH, f"job_{job['id']}")
+    status = None
+
+    async def keep_lease():
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            try:
+                await jobs.renew(job['id'], WORKER_NAME)
+            except Exception as e:
+                logger.error(f"Lease renewal of job {job['id']} failed: {e}")
+
+    heartbeat = asyncio.create_task(keep_lease())
+    try:
+        message, status = await governor.send("get_messages", chat_id, lambda: client.get_messages(chat_id, [payload['message_id'], payload['status_id']]), cost=0)
+        if message.empty:
+            return
+        if status.empty:
+            status = await governor.send("reply", chat_id, lambda: message.reply("⏳ Downloading..."))
+        if job['attempts'] > JOB_MAX_ATTEMPTS:
+            logger.error(f"Giving up on {real_url} after {job['attempts'] - 1} attempts")
+            await failure_store.set(cache_key, DOWNLOAD_FAILED)
+            await governor.edit_status(status, DOWNLOAD_FAILED.text)
+            return
+
+        default_buttons = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 OG Link", url=real_url)]]) if settings['link_btn'] else None
+        # another worker may have fetched the same link in the meantime
+        cached_data = await get_cache(cache_key)
+        if cached_data and await send_cached(client, message, cached_data, settings, default_buttons):
+            await governor.delete_status(status)
+            return
+        error_class = await failure_store.get(cache_key)
+        if error_class:
+            await governor.edit_status(status, error_class.text)
+            return
+
+        os.makedirs(save_dir, exist_ok=True)
+        await process_link(client, message, status, settings, platform, real_url, cache_key, save_dir, default_buttons)
+    except Exception as e:
+        error_class = classify_error(e)
+        if job['attempts'] < JOB_MAX_ATTEMPTS and (status is None or (error_class and error_class.transient)):
+            delay = e.value if isinstance(e, FloodWait) else JOB_RETRY_DELAY * job['attempts']
+            logger.warning(f"Job {job['id']} for {real_url} failed, retrying in {delay}s: {e}")
+            await jobs.retry(job['id'], delay)
+            return
+        if status is not None:
+            await report_error(client, status, real_url, cache_key, e)
+            if not error_class:
+                # the jobs queued behind this one for the same link would only fail the same way
+                await failure_store.set(cache_key, DOWNLOAD_FAILED)
+        else:
+            logger.error(f"Giving up on job {job['id']} for {real_url}: {e}")
+    finally:
+        heartbeat.cancel()
+        shutil.rmtree(save_dir, ignore_errors=True)
+    await jobs.finish(job['id'])
+
+async def job_runner(client, platform):
+    while True:
+        try:
+            job = await jobs.claim(platform, WORKER_NAME)
+        except Exception as e:
+            logger.error(f"Job claim error: {e}")
+            job = None
+        if job is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        try:
+            await run_job(client, job)
+        except Exception as e:
+            logger.error(f"Job {job['id']} error: {e}")
 
 @app.on_message(filters.regex(r"(tiktok\.com|instagram\.com|youtube\.com/shorts/|music\.youtube\.com)"))
 async def link_handler(client, message: Message):
     chat_id = message.chat.id
-    settings = get_settings(chat_id)
+    settings = await get_settings(chat_id)
     
-    match = re.search(r"(https?://(?:www\.)?[\w.-]*(?:tiktok\.com|instagram\.com|youtube\.com/shorts/|music\.youtube\.com).*[/\?][^\s]+)", message.text)
+    match = LINK_PATTERN.search(message.text)
     if not match: return
     raw_url = match.group(0)
 
     if "instagram.com" in raw_url and "/p/" in raw_url:
         return
     
-    status = await message.reply("⏳ Downloading...")
+    status = await governor.send("reply", message.chat.id, lambda: message.reply("⏳ Downloading..."))
     unique_id = str(message.id)
     save_dir = os.path.join(DOWNLOAD_PATH, unique_id)
-    if not os.path.exists(save_dir): os.makedirs(save_dir)
+    flight_key = cache_key = None
+    started = time.monotonic()
 
     try:
-        is_tiktok = "tiktok.com" in raw_url
-        is_yt_music = "music.youtube.com" in raw_url
-        
-        if is_tiktok:
-            real_url = raw_url
-        else:
-            real_url = await get_real_url(raw_url)
+        platform, real_url, cache_key = await resolve_link(raw_url)
+        metrics.inc("requests_total", platform=platform)
         
         default_buttons = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 OG Link", url=real_url)]]) if settings['link_btn'] else None
 
-        cached_data = await get_cache(real_url)
-        if cached_data:
-            if cached_data.get('photos'):
-                file_ids = cached_data['photos']
-                cap = cached_data['caption'] if cached_data['caption'] else ""
-                for i in range(0, len(file_ids), 10):
-                    chunk = file_ids[i:i + 10]
-                    media_group = [InputMediaPhoto(fid, caption=cap if (i==0 and idx==0 and not settings['sep_desc']) else "", parse_mode=enums.ParseMode.HTML) for idx, fid in enumerate(chunk)]
-                    await client.send_media_group(message.chat.id, media=media_group, reply_parameters=ReplyParameters(message_id=message.id))
-                if settings['desc'] and settings['sep_desc'] and cap:
-                    await message.reply(cap, reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML)
-                await status.delete()
-                return
+        cached_data = await get_cache(cache_key)
+        if cached_data and await send_cached(client, message, cached_data, settings, default_buttons):
+            metrics.inc("cache_hits_total")
+            await governor.delete_status(status)
+            return
+        metrics.inc("cache_misses_total")
 
-            elif cached_data.get('video'):
-                try:
-                    vid_cap = cached_data['caption'] if (cached_data['caption'] and not settings['sep_desc']) else ""
-                    vid_btn = default_buttons if not settings['sep_desc'] else None
-                    await client.send_video(message.chat.id, video=cached_data['video'], caption=vid_cap, reply_markup=vid_btn, reply_parameters=ReplyParameters(message_id=message.id), parse_mode=enums.ParseMode.HTML)
-                    if settings['desc'] and settings['sep_desc'] and cached_data['caption']:
-                        await message.reply(cached_data['caption'], reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML)
-                    await status.delete()
-                    return
-                except Exception as e:
-                    logging.warning(f"Cache expired: {e}")
-
-        if is_tiktok:
-            success, caption, meta_title, meta_artist = await download_gallery(real_url, save_dir)
-            if not settings['desc']:
-                caption = ""
-            if success:
-                await status.edit_text("🔄️ Uploading...")
-                photos = sorted([os.path.join(r, f) for r, _, fs in os.walk(save_dir) for f in fs if f.lower().endswith(('.jpg', '.png', '.webp'))])
-                video_file = next((os.path.join(r, f) for r, _, fs in os.walk(save_dir) for f in fs if f.lower().endswith('.mp4')), None)
-                audio_file = next((os.path.join(r, f) for r, _, fs in os.walk(save_dir) for f in fs if f.lower().endswith(('.mp3', '.m4a'))), None)
-
-                if photos:
-                    uploaded_file_ids = []
-                    for i in range(0, len(photos), 10):
-                        chunk = photos[i:i + 10]
-                        media_group = [InputMediaPhoto(p, caption=caption if (i==0 and idx==0 and not settings['sep_desc']) else "", parse_mode=enums.ParseMode.HTML) for idx, p in enumerate(chunk)]
-                        msgs = await client.send_media_group(message.chat.id, media=media_group, reply_parameters=ReplyParameters(message_id=message.id))
-                        uploaded_file_ids.extend([m.photo.file_id for m in msgs if m.photo])
-                    
-                    if uploaded_file_ids: await update_cache(real_url, photos=uploaded_file_ids, caption=caption)
-                    if audio_file and settings['audio']:
-                        sent_audio = await client.send_audio(message.chat.id, audio_file, title=meta_title, performer=meta_artist, reply_parameters=ReplyParameters(message_id=message.id))
-                        if sent_audio.audio: await update_cache(real_url, audio_id=sent_audio.audio.file_id)
-
-                elif video_file:
-                    vid_cap = caption if not settings['sep_desc'] else ""
-                    vid_btn = default_buttons if not settings['sep_desc'] else None
-                    sent_msg = await client.send_video(message.chat.id, video=video_file, caption=vid_cap, reply_markup=vid_btn, reply_parameters=ReplyParameters(message_id=message.id), parse_mode=enums.ParseMode.HTML)
-                    if sent_msg.video: await update_cache(real_url, video_id=sent_msg.video.file_id, caption=caption)
-
-                if settings['desc'] and settings['sep_desc'] and caption:
-                    await message.reply(caption, reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML)
-                
-                await status.delete()
-                return
+        error_class = await failure_store.get(cache_key)
+        if error_class:
+            metrics.inc("failure_cache_hits_total")
+            await governor.edit_status(status, error_class.text)
+            return
 
-        info = await asyncio.to_thread(get_meta_info, real_url)
-        caption = ""
+        if ROLE == "front":
+            try:
+                await jobs.put(platform, job_payload(message, status, settings, real_url, cache_key))
+            except QueueFull:
+                await governor.edit_status(status, QUEUE_FULL_TEXT)
+            return
 
-        if info:
-            author = html.escape(info.get('uploader', 'User'))
-            desc = html.escape(info.get('description', '') or info.get('title', ''))
-            if len(desc) > 800: desc = desc[:800] + "..."
-            if settings['desc']: caption = f"<blockquote expandable><b>{author}</b>\n\n{desc}</blockquote>"
+        # if the leader ends without a cache row, one of its waiters takes over and the rest keep waiting
+        while (running := inflight.claim(cache_key)) is not None:
+            await asyncio.shield(running)
+            error_class = await failure_store.get(cache_key)
+            if error_class:
+                await governor.edit_status(status, error_class.text)
+                return
+            cached_data = await get_cache(cache_key)
+            if cached_data and await send_cached(client, message, cached_data, settings, default_buttons):
+                metrics.inc("coalesced_requests_total")
+                await governor.delete_status(status)
+                return
+        flight_key = cache_key
 
-        if is_yt_music:
-            info = await asyncio.to_thread(get_meta_info, real_url)
-            meta_title = info.get('track') or info.get('title') or "Audio" if info else "Audio"
-            meta_artist = info.get('artist') or info.get('uploader') or "Bot" if info else "Bot"
-            
-            if await asyncio.to_thread(download_audio_force, real_url, save_dir):
-                await status.edit_text("🔄️ Uploading...")
-                audio_file = next((os.path.join(r, f) for r, _, fs in os.walk(save_dir) for f in fs if f.endswith(('.mp3', '.m4a'))), None)
-                if audio_file:
-                    sent_audio = await client.send_audio(message.chat.id, audio_file, title=meta_title, performer=meta_artist, reply_markup=default_buttons, reply_parameters=ReplyParameters(message_id=message.id))
-                await status.delete()
-            else:
-                await status.edit_text("❌ Audio download error.")
+        async def report_position(position):
+            try:
+                await governor.edit_status(status, f"🕒 In queue: #{position}" if position else "⏳ Downloading...")
+            except Exception:
+                pass
 
-        else:
-            tasks = [asyncio.to_thread(download_video, real_url, save_dir)]
-            if settings['audio']: tasks.append(asyncio.to_thread(download_audio_force, real_url, save_dir))
-            
-            results = await asyncio.gather(*tasks)
-            vid_path, info = results[0]
-            
-            caption = ""
-            if info:
-                author = html.escape(info.get('uploader', 'User'))
-                desc = html.escape(info.get('description', '') or info.get('title', ''))
-                if len(desc) > 800: desc = desc[:800] + "..."
-                if settings['desc']: caption = f"<blockquote expandable><b>{author}</b>\n\n{desc}</blockquote>"
-            
-            if vid_path and os.path.exists(vid_path):
-                await status.edit_text("🔄️ Uploading...")
-                vid_cap = caption if not settings['sep_desc'] else ""
-                vid_btn = default_buttons if not settings['sep_desc'] else None
-                
-                sent_msg = await client.send_video(
-                    message.chat.id, 
-                    video=vid_path, 
-                    caption=vid_cap, 
-                    reply_markup=vid_btn, 
-                    reply_parameters=ReplyParameters(message_id=message.id), 
-                    parse_mode=enums.ParseMode.HTML
-                )
-                
-                if sent_msg.video: 
-                    await update_cache(real_url, video_id=sent_msg.video.file_id, caption=caption)
-
-                if settings['desc'] and settings['sep_desc'] and caption:
-                    await message.reply(caption, reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML)
-
-                await status.delete()
-            else:
-                await status.edit_text("❌ Video download error.")
+        if not os.path.exists(save_dir): os.makedirs(save_dir)
+        try:
+            await scheduler.submit(
+                platform, chat_id,
+                lambda: process_link(client, message, status, settings, platform, real_url, cache_key, save_dir, default_buttons),
+                on_position=report_position
+            )
+        except QueueFull:
+            await governor.edit_status(status, QUEUE_FULL_TEXT)
 
     except Exception as e:
-        logger.error(f"Error processing {raw_url}: {e}")
-        error_text = str(e)
-        user_msg = (
-            "Uh-oh. Houston, we have a problem:\n"
-            f"<blockquote expandable>{html.escape(error_text)}</blockquote>"
-        )
-        try:
-            await status.edit_text(user_msg, parse_mode=enums.ParseMode.HTML)
-        except Exception:
-            pass
-        if hasattr(config, 'OWNER_ID'):
-            tb_text = traceback.format_exc()
-            doc = io.BytesIO(tb_text.encode('utf-8'))
-            doc.name = "error_log.txt"
-            try:
-                owner_report = (
-                    f"🚨 <b>Something happened...</b>\n"
-                    f"<blockquote expandable>{html.escape(error_text)}</blockquote>\n"
-                )
-                await client.send_document(config.OWNER_ID, document=doc, caption=owner_report, parse_mode=enums.ParseMode.HTML)
-            except Exception as admin_err:
-                logger.error(f"Failed to send log file: {admin_err}")
-            except Exception as owner_err:
-                logger.error(f"Failed to send log to owner: {owner_err}")
+        await report_error(client, status, raw_url, cache_key, e)
     finally:
+        metrics.observe("request", time.monotonic() - started)
+        if flight_key: inflight.release(flight_key)
         await asyncio.sleep(2)
         if os.path.exists(save_dir): shutil.rmtree(save_dir, ignore_errors=True)
 
+INLINE_SETTINGS = {**DEFAULT_SETTINGS, "sep_desc": False, "link_btn": False}
+inline_fetches = set()
+# background fetches per inline user, counted until they stop for 10 minutes
+inline_fetch_counts = TTLCache(10000, 600)
+
+def inline_results(cached_data, default_buttons):
+    caption = cached_data['caption'] or ""
+    if cached_data.get('video'):
+        return [InlineQueryResultCachedVideo(cached_data['video'], id="v", title="Video", caption=caption, reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML)]
+    results = [
+        InlineQueryResultCachedPhoto(file_id, id=f"p{idx}", caption=caption if idx == 0 else "", reply_markup=default_buttons, parse_mode=enums.ParseMode.HTML)
+        for idx, file_id in enumerate((cached_data.get('photos') or [])[:49])
+    ]
+    if cached_data.get('audio'):
+        results.append(InlineQueryResultCachedAudio(cached_data['audio'], id="a", reply_markup=default_buttons))
+    return results
+
+async def fetch_for_inline(client, platform, real_url, cache_key):
+    """Download a link into the storage chat so the next inline query for it is a cache hit."""
+    running = inflight.claim(cache_key)
+    if running is not None:
+        return
+    save_dir = status = None
+    try:
+        message = await governor.send("send_message", CACHE_CHAT_ID, lambda: client.send_message(CACHE_CHAT_ID, real_url, disable_web_page_preview=True))
+        status = await governor.send("reply", CACHE_CHAT_ID, lambda: message.reply("⏳ Downloading..."))
+        if ROLE == "front":
+            await jobs.put(platform, job_payload(message, status, INLINE_SETTINGS, real_url, cache_key))
+            return
+        save_dir = os.path.join(DOWNLOAD_PATH, f"inline_{message.id}")
+        os.makedirs(save_dir, exist_ok=True)
+        await scheduler.submit(
+            platform, CACHE_CHAT_ID,
+            lambda: process_link(client, message, status, INLINE_SETTINGS, platform, real_url, cache_key, save_dir, None)
+        )
+    except QueueFull:
+        await governor.edit_status(status, QUEUE_FULL_TEXT)
+    except Exception as e:
+        if status is not None:
+            await report_error(client, status, real_url, cache_key, e)
+        else:
+            logger.error(f"Inline fetch of {real_url} failed: {e}")
+    finally:
+        inflight.release(cache_key)
+        if save_dir: shutil.rmtree(save_dir, ignore_errors=True)
+
+@app.on_inline_query()
+async def inline_handler(client, query):
+    async def answer(results, **kwargs):
+        await governor.send("answer_inline_query", query.from_user.id, lambda: query.answer(results, cache_time=0, **kwargs), cost=0)
+
+    match = LINK_PATTERN.search(query.query)
+    if not match or ("instagram.com" in match.group(0) and "/p/" in match.group(0)):
+        await answer([], switch_pm_text="Paste a TikTok, Shorts, Reels or YT Music link", switch_pm_parameter="start")
+        return
+    metrics.inc("inline_queries_total")
+
+    try:
+        platform, real_url, cache_key = await resolve_link(match.group(0))
+        cached_data = await get_cache(cache_key)
+        results = inline_results(cached_data, InlineKeyboardMarkup([[InlineKeyboardButton("🔗 OG Link", url=real_url)]])) if cached_data else []
+        if results:
+            metrics.inc("inline_hits_total")
+            await answer(results, is_gallery=not cached_data.get('video'))
+            return
+
+        error_class = await failure_store.get(cache_key)
+        if error_class:
+            text = error_class.text
+        elif CACHE_CHAT_ID and inline_fetch_counts.get(query.from_user.id, 0) >= INLINE_FETCH_LIMIT:
+            text = "🚦 Too many new links, send them to me directly"
+        elif CACHE_CHAT_ID:
+            inline_fetch_counts.set(query.from_user.id, inline_fetch_counts.get(query.from_user.id, 0) + 1)
+            task = asyncio.create_task(fetch_for_inline(client, platform, real_url, cache_key))
+            inline_fetches.add(task)
+            task.add_done_callback(inline_fetches.discard)
+            text = "⏳ Downloading, try again in a few seconds"
+        else:
+            text = "Not cached yet, send me the link first"
+        await answer([], switch_pm_text=text, switch_pm_parameter="start")
+    except Exception as e:
+        logger.error(f"Inline query error for {query.query}: {e}")
+
 async def start_bot():
-    await init_db()
-    print("🚀 Starting bot...")
+    os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+    await cache_store.open()
+    await settings_store.open()
+    await failure_store.open()
+    if ROLE != "worker":
+        await cache_store.migrate_keys(canonical_key)
+        await settings_store.migrate_json(SETTINGS_FILE)
+    if ROLE != "standalone":
+        await jobs.open()
+    sweeper = asyncio.create_task(cache_store.sweep_loop())
+    if ROLE == "standalone":
+        scheduler.start()
+    ytdlp.start()
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    print(f"🚀 Starting bot ({ROLE})...")
     await app.start()
     
-    await app.set_bot_commands([
-        BotCommand("start", "Start/restart bot"),
-        BotCommand("settings", "Download preferences")
-    ])
+    runners = []
+    if ROLE == "worker":
+        runners = [asyncio.create_task(job_runner(app, platform)) for platform, count in PLATFORM_WORKERS.items() for _ in range(count)]
+    else:
+        try:
+            await app.set_bot_commands([
+                BotCommand("start", "Start/restart bot"),
+                BotCommand("settings", "Download preferences")
+            ])
+        except FloodWait as e:
+            # the commands from the previous start are still registered
+            logger.warning(f"Skipped setting bot commands: {e}")
     
     print("✅ Bot started!")
     await idle()
+    for runner in runners:
+        runner.cancel()
+    await asyncio.gather(*runners, return_exceptions=True)
     await app.stop()
+    await scheduler.stop()
+    ytdlp.stop()
+    await close_http_session()
+    if metrics_runner: await metrics_runner.cleanup()
+    sweeper.cancel()
+    await settings_store.close()
+    await cache_store.close()
 
 if __name__ == "__main__":
     try:
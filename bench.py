@@ -0,0 +1,340 @@
+import os
+import sys
+import types
+import time
+import json
+import logging
+import random
+import asyncio
+import argparse
+import tempfile
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+from aiohttp import web
+
+# Offline benchmark for KPDLoader: drives link_handler with synthetic messages
+# against a fake Telegram client and a local media server, so throughput can be
+# compared before and after a change without touching Telegram or any platform.
+#
+#   python bench.py --concurrency 1 4 16 --hit-ratio 0 0.5 0.9 --requests 100
+
+DONE_PREFIXES = ("❌", "🚦", "Uh-oh")
+
+class FakeClient:
+    """Stands in for pyrogram.Client: records sends and simulates upload latency.
+
+    Sending a file_id costs only the base latency; sending a local file also pays
+    for its size at the configured upload bandwidth.
+    """
+
+    def __init__(self, latency, upload_mbps):
+        self.latency = latency
+        self.upload_mbps = upload_mbps
+        self.calls = []
+        self.counter = 0
+
+    async def _upload(self, kind, items):
+        delay = self.latency
+        for item in items:
+            if isinstance(item, str) and os.path.isfile(item):
+                delay += os.path.getsize(item) * 8 / (self.upload_mbps * 1_000_000)
+        self.calls.append((kind, len(items)))
+        await asyncio.sleep(delay)
+
+    def _file_id(self, prefix):
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+
+    async def send_video(self, chat_id, video, **kwargs):
+        await self._upload("video", [video])
+        return SimpleNamespace(video=SimpleNamespace(file_id=self._file_id("v")))
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        await self._upload("audio", [audio])
+        return SimpleNamespace(audio=SimpleNamespace(file_id=self._file_id("a")))
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._upload("media_group", [m.media for m in media])
+        return [SimpleNamespace(photo=SimpleNamespace(file_id=self._file_id("p"))) for _ in media]
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.calls.append(("document", 1))
+
+class FakeStatus:
+    def __init__(self, message):
+        self.message = message
+        self.chat = message.chat
+        self.id = message.id
+
+    async def edit_text(self, text, **kwargs):
+        if text.startswith(DONE_PREFIXES):
+            self.message.finish(ok=False)
+
+    async def edit_reply_markup(self, *args, **kwargs):
+        pass
+
+    async def delete(self):
+        self.message.finish(ok=True)
+
+class FakeMessage:
+    """Just enough of pyrogram's Message for link_handler.
+
+    The request counts as finished when the bot deletes or fails its status
+    message, not when the handler returns (it lingers to clean up save_dir).
+    """
+
+    def __init__(self, message_id, chat_id, text):
+        self.id = message_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.text = text
+        self.started = time.monotonic()
+        self.finished = None
+        self.ok = False
+        self.done = asyncio.Event()
+
+    def finish(self, ok):
+        if self.finished is None:
+            self.finished = time.monotonic()
+            self.ok = ok
+            self.done.set()
+
+    async def reply(self, text, **kwargs):
+        return FakeStatus(self)
+
+class MediaServer:
+    """Serves fixture media: one video per /v/<id>.mp4 and photo posts under /p/<id>/."""
+
+    def __init__(self, video_bytes, photo_bytes, audio_bytes):
+        self.video = video_bytes
+        self.photo = photo_bytes
+        self.audio = audio_bytes
+        self.runner = None
+        self.base = None
+
+    async def start(self):
+        web_app = web.Application()
+        web_app.router.add_get("/v/{id}.mp4", lambda request: web.Response(body=self.video, content_type="video/mp4"))
+        web_app.router.add_get("/p/{id}/{n}.jpg", lambda request: web.Response(body=self.photo, content_type="image/jpeg"))
+        web_app.router.add_get("/p/{id}/audio.mp3", lambda request: web.Response(body=self.audio, content_type="audio/mpeg"))
+        self.runner = web.AppRunner(web_app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        self.base = f"http://127.0.0.1:{self.runner.addresses[0][1]}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+def load_bot(workdir):
+    """Import KPDLoader inside workdir with a throwaway config if there is none."""
+    os.chdir(workdir)
+    try:
+        import config
+    except ImportError:
+        config = types.ModuleType("config")
+        config.API_ID, config.API_HASH, config.BOT_TOKEN = 1, "bench", "1:bench"
+        sys.modules["config"] = config
+    import KPDLoader
+    logging.getLogger().setLevel(logging.WARNING)
+    return KPDLoader
+
+def install_fixtures(bot, server, photos):
+    """Point the bot's network edges at the local media server.
+
+    yt-dlp gets a local .mp4 in place of every Shorts link and fetches it through
+    its generic extractor; TikTok photo posts go through a gallery-dl stand-in that
+    pulls the post's photos and audio from the same server.
+    """
+    ytdlp_run = bot.ytdlp.run
+
+    async def run(op, url, **kwargs):
+        return await ytdlp_run(op, f"{server.base}/v/{urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]}.mp4", **kwargs)
+
+    async def download_gallery(url, save_dir, on_file=None, on_metadata=None):
+        post_id = url.rstrip('/').rsplit('/', 1)[-1]
+        metadata = {'desc': f"bench post {post_id}", 'author': {'nickname': "bench"}, 'music': {'title': "bench", 'authorName': "bench"}}
+        if on_metadata: on_metadata(metadata)
+        session = bot.get_http_session()
+        with bot.metrics.span("download_gallery"):
+            for name in [f"{n}.jpg" for n in range(photos)] + ["audio.mp3"]:
+                async with session.get(f"{server.base}/p/{post_id}/{name}") as resp:
+                    data = await resp.read()
+                path = os.path.join(save_dir, name)
+                with open(path, "wb") as f:
+                    f.write(data)
+                bot.metrics.inc("bytes_downloaded_total", len(data))
+                if on_file: on_file(path)
+        return True, metadata
+
+    bot.ytdlp.run = run
+    bot.download_gallery = download_gallery
+
+class Workload:
+    """Generates links: a hit_ratio share repeats already cached posts, the rest are new."""
+
+    def __init__(self, photo_share, chats):
+        self.photo_share = photo_share
+        self.chats = chats
+        self.next_id = 0
+        self.next_message = 0
+        self.warm = []
+
+    def fresh_link(self):
+        self.next_id += 1
+        if random.random() < self.photo_share:
+            return f"https://www.tiktok.com/@bench/photo/{7000000000000000000 + self.next_id}"
+        return f"https://www.youtube.com/shorts/bench{self.next_id:06d}?feature=share"
+
+    def message(self, link):
+        self.next_message += 1
+        return FakeMessage(self.next_message, self.next_message % self.chats, link)
+
+async def drive(bot, client, messages, concurrency):
+    """Feed messages to link_handler with at most `concurrency` requests in flight."""
+    slots = asyncio.Semaphore(concurrency)
+    handlers = []
+
+    async def one(message):
+        async with slots:
+            message.started = time.monotonic()
+            handler = asyncio.create_task(bot.link_handler(client, message))
+            handler.add_done_callback(lambda _: message.finish(ok=False))
+            handlers.append(handler)
+            await message.done.wait()
+
+    await asyncio.gather(*(one(m) for m in messages))
+    return handlers
+
+class RssSampler:
+    """Tracks peak resident memory of this process during a run."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.task = None
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    async def _loop(self):
+        while True:
+            self.peak = max(self.peak, self.current())
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.peak = self.current()
+        self.task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        self.task.cancel()
+        return max(self.peak, self.current())
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def run_level(bot, client, workload, concurrency, hit_ratio, requests):
+    # cache the posts that will be repeated before the clock starts
+    needed = max(1, int(requests * hit_ratio))
+    while len(workload.warm) < min(needed, 20) and hit_ratio > 0:
+        link = workload.fresh_link()
+        await drive(bot, client, [workload.message(link)], 1)
+        workload.warm.append(link)
+
+    links = [random.choice(workload.warm) if random.random() < hit_ratio else workload.fresh_link() for _ in range(requests)]
+    messages = [workload.message(link) for link in links]
+    hits_before = bot.metrics.counter("cache_hits_total")
+
+    sampler = RssSampler()
+    sampler.start()
+    started = time.monotonic()
+    handlers = await drive(bot, client, messages, concurrency)
+    elapsed = time.monotonic() - started
+    peak_rss = sampler.stop()
+
+    latencies = [m.finished - m.started for m in messages]
+    result = {
+        'concurrency': concurrency,
+        'hit_ratio': hit_ratio,
+        'requests': requests,
+        'failed': sum(1 for m in messages if not m.ok),
+        'cache_hits': bot.metrics.counter("cache_hits_total") - hits_before,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'rps': requests / elapsed if elapsed else 0.0,
+        'peak_rss_mb': peak_rss / 1024 / 1024,
+    }
+    await asyncio.gather(*handlers, return_exceptions=True)
+    return result
+
+async def main(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="kpd-bench-")
+    bot = load_bot(workdir)
+
+    if args.fixture:
+        with open(args.fixture, "rb") as f:
+            video = f.read()
+    else:
+        video = os.urandom(args.video_kb * 1024)
+    server = MediaServer(video, os.urandom(args.photo_kb * 1024), os.urandom(256 * 1024))
+    await server.start()
+    install_fixtures(bot, server, args.photos)
+
+    client = FakeClient(args.latency, args.upload_mbps)
+    workload = Workload(args.photo_share, args.chats)
+
+    await bot.cache_store.open()
+    await bot.settings_store.open()
+    await bot.failure_store.open()
+    bot.scheduler.start()
+    bot.ytdlp.start()
+    results = []
+    try:
+        print(f"{'conc':>5} {'hit%':>5} {'reqs':>5} {'fail':>5} {'hits':>5} {'p50 s':>8} {'p95 s':>8} {'req/s':>8} {'RSS MB':>8}")
+        for hit_ratio in args.hit_ratio:
+            for concurrency in args.concurrency:
+                r = await run_level(bot, client, workload, concurrency, hit_ratio, args.requests)
+                results.append(r)
+                print(f"{r['concurrency']:>5} {r['hit_ratio']:>5.0%} {r['requests']:>5} {r['failed']:>5} {r['cache_hits']:>5} "
+                      f"{r['p50']:>8.3f} {r['p95']:>8.3f} {r['rps']:>8.2f} {r['peak_rss_mb']:>8.1f}")
+    finally:
+        await bot.scheduler.stop()
+        bot.ytdlp.stop()
+        await bot.close_http_session()
+        await bot.settings_store.close()
+        await bot.cache_store.close()
+        await server.stop()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=4)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline KPDLoader throughput benchmark")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--hit-ratio", type=float, nargs="+", default=[0.0, 0.5, 0.9])
+    parser.add_argument("--requests", type=int, default=50, help="measured requests per level")
+    parser.add_argument("--photo-share", type=float, default=0.3, help="share of links that are TikTok photo posts")
+    parser.add_argument("--photos", type=int, default=12, help="photos per photo post")
+    parser.add_argument("--chats", type=int, default=8)
+    parser.add_argument("--video-kb", type=int, default=2048)
+    parser.add_argument("--photo-kb", type=int, default=200)
+    parser.add_argument("--fixture", help="real video file to serve instead of random bytes (lets the ffmpeg remux succeed)")
+    parser.add_argument("--latency", type=float, default=0.05, help="base latency of every Telegram call, seconds")
+    parser.add_argument("--upload-mbps", type=float, default=200.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON for later comparison")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.fixture:
+        args.fixture = os.path.abspath(args.fixture)
+    asyncio.run(main(args))
@@ -0,0 +1,171 @@
+import copy
+import logging
+import threading
+from typing import Any, NamedTuple, Optional
+import yt_dlp
+
+# This module holds everything that touches yt-dlp. It is imported both by the bot
+# (thread backend) and by the worker processes of the process backend, so it must
+# stay free of pyrogram and config imports. The workers are spawned, so they also
+# re-import the bot's entry script as __mp_main__ and pay for its imports once at
+# start-up; KPDLoader keeps its other side effects out of import time for them.
+
+class YtdlpRequest(NamedTuple):
+    op: str
+    url: str
+    save_dir: Optional[str] = None
+    info: Optional[dict] = None
+    max_bytes: Optional[int] = None
+
+class YtdlpResponse(NamedTuple):
+    ok: bool
+    value: Any = None
+    error: Optional[str] = None
+    error_type: Optional[str] = None
+
+class YtdlpError(Exception):
+    def __init__(self, message, error_type=None):
+        super().__init__(message)
+        self.error_type = error_type
+
+_local = threading.local()
+
+def init_worker():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - [%(levelname)s] - %(name)s - %(message)s")
+    get_ydl('meta')
+    get_ydl('resolve')
+
+def get_ydl(kind):
+    """Return a long-lived YoutubeDL for option sets that do not depend on the request."""
+    instances = getattr(_local, 'instances', None)
+    if instances is None:
+        instances = _local.instances = {}
+    if kind not in instances:
+        if kind == 'resolve':
+            ydl_opts = {'quiet': True, 'extract_flat': True}
+        else:
+            ydl_opts = {'quiet': True, 'noplaylist': True}
+        instances[kind] = yt_dlp.YoutubeDL(ydl_opts)
+    return instances[kind]
+
+def resolve_via_ytdlp(url):
+    """Return (real_url, info).
+
+    extract_flat only spares playlists, so a single video comes back fully
+    extracted; its info is returned so the caller doesn't extract it again.
+    """
+    try:
+        ydl = get_ydl('resolve')
+        info = ydl.extract_info(url, download=False)
+        real_url = info.get('webpage_url', info.get('url', url))
+        return real_url, ydl.sanitize_info(info) if info.get('_type', 'video') == 'video' else None
+    except Exception:
+        pass
+    return url, None
+
+def download_with_info(ydl, url, info):
+    """Run yt-dlp's download stage on an already extracted info dict.
+
+    Mirrors YoutubeDL.download_with_info_file without the JSON round-trip through
+    disk; falls back to a fresh extraction if there is no info or it went stale.
+    """
+    if info:
+        try:
+            return ydl.process_ie_result(ydl.sanitize_info(copy.deepcopy(info), True), download=True)
+        except (yt_dlp.utils.DownloadError, yt_dlp.utils.ReExtractInfo) as e:
+            logging.warning(f"Stored info failed to download, re-extracting: {e}")
+            url = info.get('webpage_url') or url
+    return ydl.extract_info(url, download=True)
+
+def download_audio_force(url, save_dir, info=None):
+    ydl_opts = {
+        'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        'outtmpl': f'{save_dir}/source.%(ext)s',
+        'noplaylist': True, 'quiet': True,
+        'concurrent_fragment_downloads': 5,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = download_with_info(ydl, url, info)
+        return ydl.prepare_filename(info)
+
+DEFAULT_VIDEO_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+
+def estimate_size(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and duration and fmt.get('tbr'):
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size
+
+def plan_format(info, max_bytes):
+    """Pick the best format (or video+audio pair) expected to fit into max_bytes.
+
+    Uses the sizes/bitrates already in the info dict, preferring mp4/m4a like
+    DEFAULT_VIDEO_FORMAT does. Returns (format_spec, fits); when sizes are known
+    but nothing fits, the spec names the smallest option and fits is False.
+    Returns (None, True) if the info carries no size data at all.
+    """
+    duration = info.get('duration')
+    audios, candidates = [], []
+    for f in info.get('formats') or []:
+        size = estimate_size(f, duration)
+        if not size or not f.get('format_id'):
+            continue
+        if f.get('vcodec') == 'none':
+            if f.get('acodec') not in (None, 'none'):
+                audios.append((f, size))
+        elif f.get('acodec') != 'none':
+            rank = (f.get('ext') == 'mp4', f.get('height') or 0, f.get('tbr') or 0)
+            candidates.append((rank, size, f['format_id']))
+
+    for f in info.get('formats') or []:
+        size = estimate_size(f, duration)
+        if not size or f.get('vcodec') in (None, 'none') or f.get('acodec') != 'none':
+            continue
+        for a, audio_size in audios:
+            rank = (f.get('ext') == 'mp4' and a.get('ext') == 'm4a', f.get('height') or 0, (f.get('tbr') or 0) + (a.get('tbr') or a.get('abr') or 0))
+            candidates.append((rank, size + audio_size, f"{f['format_id']}+{a['format_id']}"))
+
+    if not candidates:
+        return None, True
+    fitting = [c for c in candidates if c[1] <= max_bytes]
+    if fitting:
+        return max(fitting, key=lambda c: c[0])[2], True
+    return min(candidates, key=lambda c: c[1])[2], False
+
+def download_video(url, save_dir, info=None, max_bytes=None):
+    ydl_opts = {
+        'format': DEFAULT_VIDEO_FORMAT,
+        'outtmpl': f'{save_dir}/video.%(ext)s',
+        'noplaylist': True, 'quiet': True,
+        'concurrent_fragment_downloads': 5,
+        'merge_output_format': 'mp4',
+        'postprocessor_args': {'merger': ['-movflags', '+faststart']},
+    }
+    if info and max_bytes:
+        spec, fits = plan_format(info, max_bytes)
+        if spec:
+            # the ids come from info that may have gone stale; fall back rather than fail
+            ydl_opts['format'] = f"{spec}/{DEFAULT_VIDEO_FORMAT}"
+        if not fits:
+            logging.warning(f"No format of {url} fits into {max_bytes} bytes, using the smallest one")
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = download_with_info(ydl, url, info)
+        return ydl.prepare_filename(info), ydl.sanitize_info(info)
+
+def get_meta_info(url):
+    ydl = get_ydl('meta')
+    return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+OPS = {
+    'resolve': lambda req: resolve_via_ytdlp(req.url),
+    'meta': lambda req: get_meta_info(req.url),
+    'audio': lambda req: download_audio_force(req.url, req.save_dir, req.info),
+    'video': lambda req: download_video(req.url, req.save_dir, req.info, req.max_bytes),
+}
+
+def handle(request):
+    """Entry point for both backends: never raises, errors travel back in the response."""
+    try:
+        return YtdlpResponse(True, OPS[request.op](request))
+    except Exception as e:
+        return YtdlpResponse(False, error=str(e), error_type=type(e).__name__)